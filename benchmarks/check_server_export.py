@@ -0,0 +1,78 @@
+'''
+Checks --ingest's reader of database table exports against the small export in benchmarks/fixtures/server_export
+
+The fixture grants every numeric perm_id that can be stored in the permission tables, so a wrong entry in
+resources/server_export.PERMISSIONS shows up as a wrong permission, flattened privilege or workspace wide access. e.g.
+    python benchmarks/check_server_export.py
+'''
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# resources/instance_init.py reads its configuration from an "env" module when imported, nothing is requested here
+env = sys.modules['env'] = types.ModuleType('env')
+env.server_username = env.server_password = env.cloud_username = env.cloud_password = 'check'
+env.cloud_workspace = 'workspace'
+
+from resources.mirror_operations import ServerDetails as SD, ActionOnItems as AOI
+from resources.permissions import PermissionFlattener
+
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'server_export')
+
+EXPECTED_GLOBAL = {'stash-users': 'LICENSED_USER', 'project-creators': 'PROJECT_CREATE', 'bitbucket-admins': 'ADMIN', 'system-admins': 'SYS_ADMIN'}
+EXPECTED_WORKSPACE_ACCESS = {'stash-users': None, 'project-creators': None, 'bitbucket-admins': 'admin', 'system-admins': 'admin'}
+EXPECTED_PROJECTS = {
+    'CORE': ('None', {'core-viewers': 'PROJECT_VIEW', 'core-readers': 'PROJECT_READ', 'core-writers': 'PROJECT_WRITE', 'core-admins': 'PROJECT_ADMIN'}),
+    'WEB': ('Write', {}),
+}
+EXPECTED_REPOS = {
+    'core-api': {'api-readers': 'REPO_READ', 'api-writers': 'REPO_WRITE'},
+    'core-lib': {'lib-admins': 'REPO_ADMIN'},
+    'web-app': {},
+}
+EXPECTED_PRIVILEGES = {
+    'core-api': {'core-readers': 'read', 'core-writers': 'write', 'core-admins': 'admin', 'api-readers': 'read', 'api-writers': 'write'},
+    'core-lib': {'core-readers': 'read', 'core-writers': 'write', 'core-admins': 'admin', 'lib-admins': 'admin'},
+}
+
+
+def check(label: str, got, expected) -> bool:
+    if got == expected:
+        return True
+    print(f'FAIL: {label}\n  expected {expected}\n  got      {got}')
+    return False
+
+
+def main() -> None:
+    groups_to_migrate, global_groups, server_structure = SD.ingest_server_structure(FIXTURE)
+    ok = check('global permissions', {group.name: group.permission for group in global_groups}, EXPECTED_GLOBAL)
+    ok &= check('workspace wide access', {group.name: AOI.global_group_access(group.name, groups_to_migrate)[1] for group in global_groups},
+                EXPECTED_WORKSPACE_ACCESS)
+
+    projects = {project.key: project for project in server_structure}
+    ok &= check('projects (personal projects skipped)', sorted(projects), sorted(EXPECTED_PROJECTS))
+    for key, (default_permission, groups) in EXPECTED_PROJECTS.items():
+        project = projects.get(key)
+        ok &= check(f'{key} default permission', project and project.default_permission, default_permission)
+        ok &= check(f'{key} group permissions', project and {group.name: group.permission for group in project.groups}, groups)
+
+    repos = {repo.slug: repo for project in server_structure for repo in project.repositories}
+    ok &= check('repos', sorted(repos), sorted(EXPECTED_REPOS))
+    for slug, groups in EXPECTED_REPOS.items():
+        ok &= check(f'{slug} group permissions', slug in repos and {group.name: group.permission for group in repos[slug].groups}, groups)
+
+    flattener = PermissionFlattener(groups_to_migrate)
+    for project in server_structure:
+        for repo in project.repositories:
+            if repo.slug in EXPECTED_PRIVILEGES:
+                ok &= check(f'{repo.slug} flattened privileges', dict(flattener.flatten(project, repo)), EXPECTED_PRIVILEGES[repo.slug])
+
+    print('OK' if ok else 'FAILED')
+    exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+'''
+Local stand-in for the parts of the Bitbucket Server and Bitbucket Cloud REST APIs used by this tool.
+
+A Topology describes a synthetic server instance (projects, repos, groups, users, grants) and the cloud
+workspace it is being mirrored into. MockBitbucket serves both APIs from that topology on two local ports
+and can inject latency, 429s and 5xx responses to exercise the client-side pacing and retry logic.
+'''
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+SERVER_PROJECT_PERMS = ['PROJECT_READ', 'PROJECT_WRITE', 'PROJECT_ADMIN']
+SERVER_REPO_PERMS = ['REPO_READ', 'REPO_WRITE', 'REPO_ADMIN']
+SERVER_GLOBAL_PERMS = ['LICENSED_USER', 'PROJECT_CREATE', 'ADMIN', 'SYS_ADMIN']
+
+
+class Topology:
+    def __init__(self, projects: int=10, repos_per_project: int=10, groups: int=20, users: int=200,
+                 members_per_group: int=20, grants_per_project: int=2, grants_per_repo: int=1,
+                 global_groups: int=4, workspace_member_ratio: float=0.9, migrated_repo_ratio: float=0.95,
+                 default_permission_ratio: float=0.4, seed: int=1):
+        rng = random.Random(seed)
+        self.group_names = [f'group-{i:05d}' for i in range(groups)]
+        self.users = [{'name': f'user{i:06d}', 'emailAddress': f'user{i:06d}@example.com',
+                       'displayName': f'User {i}', 'slug': f'user{i:06d}'} for i in range(users)]
+        self.members = {name: rng.sample(self.users, min(members_per_group, users)) for name in self.group_names}
+        self.global_permissions = [{'group': {'name': name}, 'permission': SERVER_GLOBAL_PERMS[i % len(SERVER_GLOBAL_PERMS)]}
+                                   for i, name in enumerate(self.group_names[:global_groups])]
+
+        self.projects = []
+        self.project_groups = {}
+        self.project_defaults = {}
+        self.repos = {}
+        self.repo_groups = {}
+        for p in range(projects):
+            key = f'P{p:05d}'
+            self.projects.append({'key': key, 'name': f'Project {p}', 'public': rng.random() < 0.05})
+            # a project default permission grants every group access to all of the project's repos
+            self.project_defaults[key] = rng.choice(['Read', 'Write']) if rng.random() < default_permission_ratio else 'None'
+            self.project_groups[key] = [{'group': {'name': name}, 'permission': rng.choice(SERVER_PROJECT_PERMS)}
+                                        for name in rng.sample(self.group_names, min(grants_per_project, groups))]
+            self.repos[key] = []
+            for r in range(repos_per_project):
+                slug = f'{key.lower()}-repo-{r:05d}'
+                self.repos[key].append({'slug': slug, 'name': f'{key} repo {r}', 'public': rng.random() < 0.05})
+                self.repo_groups[(key, slug)] = [{'group': {'name': name}, 'permission': rng.choice(SERVER_REPO_PERMS)}
+                                                 for name in rng.sample(self.group_names, min(grants_per_repo, groups))]
+
+        self.workspace_members = {user['emailAddress'] for user in self.users if rng.random() < workspace_member_ratio}
+        self.cloud_repos = {repo['slug'] for repos in self.repos.values() for repo in repos if rng.random() < migrated_repo_ratio}
+        self.cloud_groups = {}       # slug -> {'name', 'permission', 'members': set(emails)}
+        self.cloud_privileges = {}   # (repo_slug, group_slug) -> privilege
+        self.lock = threading.Lock()
+
+    @property
+    def repo_count(self) -> int:
+        return sum(len(repos) for repos in self.repos.values())
+
+
+class Faults:
+    '''Latency added to every request, and the share of requests answered with a 429 (with Retry-After) or a 503 instead'''
+    # The credential checks made when an instance is created are never failed
+    exempt_routes = {'status', 'cluster', 'workspace_permissions'}
+
+    def __init__(self, latency: float=0.0, rate_429: float=0.0, rate_5xx: float=0.0, retry_after: float=1, seed: int=2):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def roll(self, route: str) -> int:
+        if route in self.exempt_routes:
+            return 0
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.rate_429:
+            return 429
+        if roll < self.rate_429 + self.rate_5xx:
+            return 503
+        return 0
+
+
+def _page(values: list, query: dict, default_limit: int=25, max_limit: int=1_000) -> dict:
+    start = int(query.get('start', ['0'])[0] or 0)
+    limit = min(int(query.get('limit', [str(default_limit)])[0] or default_limit), max_limit)
+    chunk = values[start:start + limit]
+    last = start + limit >= len(values)
+    body = {'size': len(chunk), 'limit': limit, 'start': start, 'isLastPage': last, 'values': chunk}
+    if not last:
+        body['nextPageStart'] = start + limit
+    return body
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    mock = None  # set on the per-server subclass
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body=None, headers: dict=None) -> None:
+        data = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = self.rfile.read(length) if length else b''
+        split = urlsplit(self.path)
+        path = unquote(split.path)
+        query = parse_qs(split.query)
+        route = self.mock.route_of(path)
+        self.mock.requests[(method, route)] += 1
+        if method != 'GET' and self.mock.first_write is None:
+            self.mock.first_write = time.perf_counter()
+        faults = self.mock.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        injected = faults.roll(route)
+        if injected == 429:
+            return self._send(429, {'error': 'rate limited'}, {'Retry-After': str(faults.retry_after)})
+        if injected:
+            return self._send(injected, {'error': 'injected failure'})
+        status, body = self.mock.dispatch(method, path, query, payload)
+        self._send(status, body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class _MockApi:
+    routes = []
+
+    def __init__(self, topology: Topology, faults: Faults, page_size: int):
+        self.topology = topology
+        self.faults = faults
+        self.page_size = page_size
+        self.requests = Counter()
+        self.first_write = None  # perf_counter() of the first POST/PUT received
+
+    def route_of(self, path: str) -> str:
+        for pattern, name in self.routes:
+            if re.match(pattern, path):
+                return name
+        return path
+
+    def dispatch(self, method: str, path: str, query: dict, payload: bytes) -> tuple:
+        for pattern, name in self.routes:
+            match = re.match(pattern, path)
+            if match:
+                handler = getattr(self, f'{method.lower()}_{name}', None)
+                if handler:
+                    return handler(query, payload, *match.groups())
+        return 404, {'errors': [{'message': f'No mock route for {method} {path}'}]}
+
+
+class MockServerApi(_MockApi):
+    routes = [
+        (r'^/status$', 'status'),
+        (r'^/rest/api/latest/admin/cluster$', 'cluster'),
+        (r'^/rest/api/latest/admin/permissions/groups$', 'global_permissions'),
+        (r'^/rest/api/latest/admin/groups$', 'groups'),
+        (r'^/rest/api/latest/admin/groups/more-members$', 'group_members'),
+        (r'^/rest/api/latest/projects$', 'projects'),
+        (r'^/rest/api/latest/projects/([^/]+)/permissions/(project_read|project_write)/all$', 'project_default'),
+        (r'^/rest/api/latest/projects/([^/]+)/permissions/groups$', 'project_groups'),
+        (r'^/rest/api/latest/projects/([^/]+)/repos$', 'repos'),
+        (r'^/rest/api/latest/projects/([^/]+)/repos/([^/]+)/permissions/groups$', 'repo_groups'),
+    ]
+
+    def _paged(self, values: list, query: dict) -> tuple:
+        return 200, _page(values, query, max_limit=self.page_size)
+
+    def get_status(self, query, payload):
+        return 200, {'state': 'RUNNING'}
+
+    def get_cluster(self, query, payload):
+        return 200, {'running': True}
+
+    def get_global_permissions(self, query, payload):
+        return self._paged(self.topology.global_permissions, query)
+
+    def get_groups(self, query, payload):
+        return self._paged([{'name': name} for name in self.topology.group_names], query)
+
+    def get_group_members(self, query, payload):
+        return self._paged(self.topology.members.get(query.get('context', [''])[0], []), query)
+
+    def get_projects(self, query, payload):
+        return self._paged(self.topology.projects, query)
+
+    def get_project_default(self, query, payload, key, permission):
+        default = self.topology.project_defaults.get(key, 'None')
+        permitted = default == 'Write' or (permission == 'project_read' and default == 'Read')
+        return 200, {'permitted': permitted}
+
+    def get_project_groups(self, query, payload, key):
+        return self._paged(self.topology.project_groups.get(key, []), query)
+
+    def get_repos(self, query, payload, key):
+        return self._paged(self.topology.repos.get(key, []), query)
+
+    def get_repo_groups(self, query, payload, key, slug):
+        return self._paged(self.topology.repo_groups.get((key, slug), []), query)
+
+
+class MockCloudApi(_MockApi):
+    routes = [
+        (r'^/2\.0/workspaces/([^/]+)/permissions$', 'workspace_permissions'),
+        (r'^/2\.0/workspaces/([^/]+)/members$', 'workspace_members'),
+        (r'^/2\.0/repositories/([^/]+)$', 'repositories'),
+        (r'^/2\.0/repositories/([^/]+)/([^/]+)$', 'repository'),
+        (r'^/1\.0/groups/([^/]+)/?$', 'groups'),
+        (r'^/1\.0/groups/([^/]+)/([^/]+)/members/([^/]+)/?$', 'group_member'),
+        (r'^/1\.0/groups/([^/]+)/([^/]+)/?$', 'group'),
+        (r'^/1\.0/group-privileges/([^/]+)/?$', 'group_privileges'),
+        (r'^/1\.0/group-privileges/([^/]+)/([^/]+)/([^/]+)/([^/]+)/?$', 'group_privilege'),
+    ]
+
+    def __init__(self, topology: Topology, faults: Faults, page_size: int, workspace: str='workspace'):
+        super().__init__(topology, faults, min(page_size, 100))
+        self.workspace = workspace
+        self.base_url = ''
+        self.member_emails = True
+
+    def _cloud_page(self, values: list, query: dict, path: str) -> dict:
+        pagelen = min(int(query.get('pagelen', ['10'])[0]), self.page_size)
+        page = int(query.get('page', ['1'])[0])
+        chunk = values[(page - 1) * pagelen:page * pagelen]
+        body = {'pagelen': pagelen, 'page': page, 'size': len(values), 'values': chunk}
+        if page * pagelen < len(values):
+            params = '&'.join(f'{k}={v[0]}' for k, v in query.items() if k != 'page')
+            body['next'] = f'{self.base_url}{path}?{params}&page={page + 1}'
+        return body
+
+    def get_workspace_permissions(self, query, payload, workspace):
+        return 200, {'values': []}
+
+    def get_workspace_members(self, query, payload, workspace):
+        members = sorted(self.topology.workspace_members)
+        q = query.get('q', [''])[0]
+        if q:
+            wanted = set(re.findall(r'"([^"]+)"', q))
+            members = [email for email in members if email in wanted]
+        values = [{'user': {'display_name': email.split('@')[0], 'uuid': '{' + email + '}', **({'email': email} if q and self.member_emails else {})}}
+                  for email in members]
+        return 200, self._cloud_page(values, query, f'/2.0/workspaces/{workspace}/members')
+
+    def get_repositories(self, query, payload, workspace):
+        values = [{'slug': slug} for slug in sorted(self.topology.cloud_repos)]
+        return 200, self._cloud_page(values, query, f'/2.0/repositories/{workspace}')
+
+    def get_repository(self, query, payload, workspace, slug):
+        if slug in self.topology.cloud_repos:
+            return 200, {'slug': slug}
+        return 404, {'error': 'not found'}
+
+    def get_groups(self, query, payload, workspace):
+        with self.topology.lock:
+            groups = [{'name': group['name'], 'slug': slug, 'permission': group['permission'],
+                       'members': [{'username': email.split('@')[0], 'uuid': '{' + email + '}'} for email in sorted(group['members'])]}
+                      for slug, group in self.topology.cloud_groups.items()]
+        return 200, groups
+
+    def post_groups(self, query, payload, workspace):
+        name = parse_qs(payload.decode()).get('name', [''])[0]
+        with self.topology.lock:
+            if name in self.topology.cloud_groups:
+                return 400, {'error': 'group already exists'}
+            self.topology.cloud_groups[name] = {'name': name, 'permission': None, 'members': set()}
+        return 200, {'name': name, 'slug': name}
+
+    def put_group(self, query, payload, workspace, group):
+        with self.topology.lock:
+            if group not in self.topology.cloud_groups:
+                return 404, {'error': 'no such group'}
+            self.topology.cloud_groups[group]['permission'] = json.loads(payload or b'{}').get('permission')
+        return 200, {'slug': group}
+
+    def put_group_member(self, query, payload, workspace, group, email):
+        with self.topology.lock:
+            if group not in self.topology.cloud_groups or email not in self.topology.workspace_members:
+                return 404, {'error': 'not found'}
+            members = self.topology.cloud_groups[group]['members']
+            if email in members:
+                return 409, {'error': 'already a member'}
+            members.add(email)
+        return 200, {'email': email}
+
+    def delete_group_member(self, query, payload, workspace, group, email):
+        with self.topology.lock:
+            members = self.topology.cloud_groups.get(group, {}).get('members', set())
+            if email not in members:
+                return 404, {'error': 'not a member'}
+            members.discard(email)
+        return 204, None
+
+    def get_group_privileges(self, query, payload, workspace):
+        with self.topology.lock:
+            privileges = [{'repo': f'{workspace}/{repo}', 'privilege': privilege, 'group': {'slug': group, 'name': group}}
+                          for (repo, group), privilege in self.topology.cloud_privileges.items()]
+        return 200, privileges
+
+    def put_group_privilege(self, query, payload, workspace, repo, owner, group):
+        with self.topology.lock:
+            if repo not in self.topology.cloud_repos or group not in self.topology.cloud_groups:
+                return 404, {'error': 'not found'}
+            self.topology.cloud_privileges[(repo, group)] = payload.decode()
+        return 200, [{'repo': f'{workspace}/{repo}', 'privilege': payload.decode()}]
+
+    def delete_group_privilege(self, query, payload, workspace, repo, owner, group):
+        with self.topology.lock:
+            if self.topology.cloud_privileges.pop((repo, group), None) is None:
+                return 404, {'error': 'not found'}
+        return 204, None
+
+
+class MockBitbucket:
+    '''Serves a mock Bitbucket Server and a mock Bitbucket Cloud api on two local ports.'''
+    def __init__(self, topology: Topology, faults: Faults=None, page_size: int=1_000, workspace: str='workspace'):
+        self.topology = topology
+        self.faults = faults or Faults()
+        self.server_api = MockServerApi(topology, self.faults, page_size)
+        self.cloud_api = MockCloudApi(topology, self.faults, page_size, workspace)
+        self.server_url = self.cloud_url = None
+        self._servers = []
+
+    def _start(self, api: _MockApi) -> str:
+        handler = type('Handler', (_Handler,), {'mock': api})
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self._servers.append(httpd)
+        return f'http://127.0.0.1:{httpd.server_address[1]}'
+
+    def start(self) -> tuple[str, str]:
+        self.server_url = self._start(self.server_api)
+        self.cloud_url = self.cloud_api.base_url = self._start(self.cloud_api)
+        return self.server_url, self.cloud_url
+
+    def stop(self) -> None:
+        for httpd in self._servers:
+            httpd.shutdown()
+            httpd.server_close()
+        self._servers = []
+
+    def request_counts(self) -> dict:
+        return {'server': sum(self.server_api.requests.values()), 'cloud': sum(self.cloud_api.requests.values())}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,215 @@
+'''
+Offline benchmarks for a full mirror run against the local mock api in benchmarks/mock_bitbucket.py
+
+Each scale is run end to end (server scan, group + membership mirroring, repository group privileges) against a fresh
+mock, and the wall time, time to the first cloud write, number of api requests, retries and peak Python memory of every
+phase are reported. Writes that still failed after their retries are replayed from the retry queue, as --retry would.
+No credentials or network access are needed, so the numbers are comparable between changes. e.g.
+    python benchmarks/run_benchmarks.py --scales small medium --page-size 25 1000 --latency 0.005 --rate-429 0.01
+
+Every run is also checked for correctness: the groups, their workspace wide access, their members and the repository
+group privileges left in the mock workspace must equal those of a sequential baseline, one server and one cloud worker
+mirroring the same topology without injected faults. The benchmark exits with 1 when any run differs.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mock_bitbucket import MockBitbucket, Topology, Faults
+
+# The tool reads its configuration from an "env" module when resources/instance_init.py is imported,
+# so the benchmark provides its own and points it at the mock for every run
+env = sys.modules['env'] = types.ModuleType('env')
+env.server_username = env.server_password = env.cloud_username = env.cloud_password = 'benchmark'
+env.cloud_workspace = 'workspace'
+
+from resources.instance_init import ServerInstance, CloudInstance
+from resources.mirror_operations import ServerDetails as SD, ActionOnItems as AOI
+from resources.streaming import StreamingMirror
+from resources.sharding import Shard
+from resources.retry_queue import retry_queue
+from concurrent.futures import ThreadPoolExecutor
+from resources.metrics import metrics
+from resources.progress import progress
+
+
+SCALES = {
+    'small': dict(projects=10, repos_per_project=10, groups=20, users=200, members_per_group=20),
+    'medium': dict(projects=50, repos_per_project=20, groups=50, users=2_000, members_per_group=50),
+    'large': dict(projects=200, repos_per_project=25, groups=100, users=10_000, members_per_group=100),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks a full mirror run against a local mock Bitbucket Server and Cloud.')
+    parser.add_argument('--scales', nargs='+', choices=SCALES, default=['small', 'medium'], help='Topology sizes to run.')
+    parser.add_argument('--page-size', nargs='+', type=int, default=[1_000], metavar='N',
+                        help='Largest page the mock server api returns, each value is benchmarked separately (the mock cloud api caps pages at 100).')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS', help='Latency added to every mock api request.')
+    parser.add_argument('--rate-429', type=float, default=0.0, metavar='RATIO', help='Share of requests answered with a 429.')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, metavar='RATIO', help='Share of requests answered with a 503.')
+    parser.add_argument('--retry-after', type=float, default=0.5, metavar='SECONDS', help='Retry-After sent with injected 429s.')
+    parser.add_argument('--default-permission-ratio', type=float, default=0.05, metavar='RATIO',
+                        help='Share of projects with a default permission, which grants every group access to all of its repos.')
+    parser.add_argument('--stream', action='store_true', help='Mirror with StreamingMirror (--stream) instead of a full scan followed by the writes.')
+    parser.add_argument('--shards', type=int, metavar='COUNT',
+                        help='After the scan, mirror with COUNT shards run in parallel threads (--shards), each with its own sessions.')
+    parser.add_argument('--server-workers', type=int, default=8, help='server_max_workers used for the run.')
+    parser.add_argument('--cloud-workers', type=int, default=8, help='cloud_max_workers used for the run.')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to FILE as JSON.')
+    return parser.parse_args()
+
+
+def measure(results: list, phase: str, mock: MockBitbucket, function, *args):
+    before = mock.request_counts()
+    retries_before = sum(row['retries'] for row in metrics.as_dict())
+    tracemalloc.reset_peak()
+    mock.cloud_api.first_write = None
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    wall = time.perf_counter() - started
+    after = mock.request_counts()
+    first_write = mock.cloud_api.first_write
+    results.append({'phase': phase, 'wall_seconds': round(wall, 3),
+                    'first_write_seconds': round(first_write - started, 3) if first_write is not None else None,
+                    'server_requests': after['server'] - before['server'], 'cloud_requests': after['cloud'] - before['cloud'],
+                    'retries': sum(row['retries'] for row in metrics.as_dict()) - retries_before,
+                    'peak_memory_mb': round(tracemalloc.get_traced_memory()[1] / 1_000_000, 2)})
+    return result
+
+
+def mirror_shards(count: int, groups_to_migrate, global_groups, server_structure) -> None:
+    '''mirrors the scanned structure the way every shard of --shards does, in threads instead of processes'''
+    def mirror_shard(shard: Shard) -> None:
+        server, cloud = ServerInstance(), CloudInstance()
+        shard.share_request_budget(server, cloud)
+        if shard.designated:
+            AOI.mirror_groups(server, cloud, groups_to_migrate, global_groups)
+        else:
+            shard.wait_for_groups(cloud, groups_to_migrate, 600)
+        AOI.mirror_repo_groups(server, cloud, groups_to_migrate, [project for project in server_structure if shard.owns(project.key)])
+    Shard.wait_interval = 0.1
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        list(executor.map(mirror_shard, [Shard(index, count) for index in range(count)]))
+
+
+def workspace_state(topology: Topology) -> dict:
+    '''what the run left in the mock workspace'''
+    return {'groups': {slug: (group['name'], group['permission'], sorted(group['members'])) for slug, group in topology.cloud_groups.items()},
+            'privileges': dict(topology.cloud_privileges)}
+
+
+def compare(state: dict, baseline: dict) -> list[str]:
+    '''returns what differs between the workspace "state" of a run and the sequential "baseline"'''
+    differences = []
+    for part in ('groups', 'privileges'):
+        missing = baseline[part].keys() - state[part].keys()
+        extra = state[part].keys() - baseline[part].keys()
+        changed = [key for key in baseline[part].keys() & state[part].keys() if baseline[part][key] != state[part][key]]
+        for label, keys in (('missing', missing), ('unexpected', extra), ('different', changed)):
+            if keys:
+                differences.append(f'{len(keys)} {label} {part}, e.g. {sorted(keys)[0]}')
+    return differences
+
+
+def baseline_state(scale: str, args: argparse.Namespace) -> dict:
+    '''the workspace left by a sequential run without injected faults, the expected result of every benchmarked run'''
+    sequential = argparse.Namespace(**{**vars(args), 'latency': 0.0, 'rate_429': 0.0, 'rate_5xx': 0.0, 'stream': False, 'shards': None,
+                                        'server_workers': 1, 'cloud_workers': 1})
+    _, state = run(scale, 1_000, sequential)
+    return state
+
+
+def run(scale: str, page_size: int, args: argparse.Namespace) -> tuple[list[dict], dict]:
+    '''returns the results of every phase and the workspace state the run left behind'''
+    topology = Topology(**SCALES[scale], default_permission_ratio=args.default_permission_ratio)
+    faults = Faults(latency=args.latency, rate_429=args.rate_429, rate_5xx=args.rate_5xx, retry_after=args.retry_after)
+    results = []
+    with MockBitbucket(topology, faults, page_size=page_size) as mock, tempfile.TemporaryDirectory() as queue_dir:
+        env.server_url, env.cloud_api_url = mock.server_url, mock.cloud_url
+        env.server_max_workers = args.server_workers
+        env.cloud_max_workers = args.cloud_workers
+        metrics.endpoints.clear()
+        progress.clear()
+        retry_queue.open(os.path.join(queue_dir, 'retry-queue.jsonl'))
+
+        server = measure(results, 'connect', mock, ServerInstance)
+        cloud = measure(results, 'connect', mock, CloudInstance)
+        if args.stream:
+            measure(results, 'stream', mock, StreamingMirror(server, cloud).run)
+        else:
+            groups_to_migrate, global_groups, server_structure = measure(results, 'scan', mock, SD.scan_server_structure, server)
+            if args.shards:
+                measure(results, 'shards', mock, mirror_shards, args.shards, groups_to_migrate, global_groups, server_structure)
+            else:
+                measure(results, 'groups', mock, AOI.mirror_groups, server, cloud, groups_to_migrate, global_groups)
+                measure(results, 'repos', mock, AOI.mirror_repo_groups, server, cloud, groups_to_migrate, server_structure)
+        retry_queue.close()
+        if any(item['reason'] in ('write_failed', 'group_not_created') for item in retry_queue.load()):
+            measure(results, 'retry', mock, AOI.retry_queued, cloud, retry_queue)
+            retry_queue.close()
+        retry_queue.path = None
+        state = workspace_state(topology)
+
+    # Both instances are created in the connect phase, report it once
+    connect = [result for result in results if result['phase'] == 'connect']
+    results = [{'phase': 'connect', 'wall_seconds': round(sum(r['wall_seconds'] for r in connect), 3), 'first_write_seconds': None,
+                'server_requests': sum(r['server_requests'] for r in connect), 'cloud_requests': sum(r['cloud_requests'] for r in connect),
+                'retries': sum(r['retries'] for r in connect), 'peak_memory_mb': max(r['peak_memory_mb'] for r in connect)}] \
+              + [result for result in results if result['phase'] != 'connect']
+    # Time from the start of the run until the first cloud write, the phases before it add their full wall time
+    first_write, elapsed = None, 0.0
+    for result in results:
+        if result['first_write_seconds'] is not None:
+            first_write = round(elapsed + result['first_write_seconds'], 3)
+            break
+        elapsed += result['wall_seconds']
+    results.append({'phase': 'total', 'wall_seconds': round(sum(r['wall_seconds'] for r in results), 3), 'first_write_seconds': first_write,
+                    'server_requests': sum(r['server_requests'] for r in results), 'cloud_requests': sum(r['cloud_requests'] for r in results),
+                    'retries': sum(r['retries'] for r in results), 'peak_memory_mb': max(r['peak_memory_mb'] for r in results)})
+    for result in results:
+        result.update(scale=scale, page_size=page_size, projects=len(topology.projects), repos=topology.repo_count,
+                      groups=len(topology.group_names), users=len(topology.users))
+    return results, state
+
+
+def main() -> None:
+    args = parse_args()
+    tracemalloc.start()
+    print(f'{"scale":<8}{"page":>6}{"phase":>8}{"wall s":>9}{"1st write s":>12}{"server req":>12}{"cloud req":>11}{"retries":>9}{"peak MB":>9}')
+    all_results, failed = [], False
+    for scale in args.scales:
+        baseline = None
+        for page_size in args.page_size:
+            results, state = run(scale, page_size, args)
+            for result in results:
+                first_write = f'{result["first_write_seconds"]:.2f}' if result['first_write_seconds'] is not None else '-'
+                print(f'{scale:<8}{page_size:>6}{result["phase"]:>8}{result["wall_seconds"]:>9.2f}{first_write:>12}{result["server_requests"]:>12}'
+                      f'{result["cloud_requests"]:>11}{result["retries"]:>9}{result["peak_memory_mb"]:>9.1f}')
+            if baseline is None:
+                baseline = baseline_state(scale, args)
+            differences = compare(state, baseline)
+            results[-1]['matches_baseline'] = not differences
+            all_results.extend(results)
+            if differences:
+                failed = True
+                print(f'FAIL: The {scale} run with page size {page_size} left a different workspace than the sequential baseline: {"; ".join(differences)}')
+    tracemalloc.stop()
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as results_file:
+            json.dump(all_results, results_file, indent=2)
+    print('FAILED' if failed else 'OK, every run left the same workspace as the sequential baseline')
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
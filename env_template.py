@@ -1,7 +1,15 @@
 server_username = ""  # Your admin level username
 server_password = ""  # Your admin level password or personal access token https://confluence.atlassian.com/bitbucketserver/personal-access-tokens-939515499.html
 server_url = ""  # Your Server/DC's base URL https://confluence.atlassian.com/bitbucketserver077/specifying-the-base-url-for-bitbucket-server-1026551743.html
+server_max_workers = 8  # Number of concurrent requests used while scanning your Server/DC instance
+server_requests_per_second = None  # Optional cap on the request rate to your Server/DC instance, None paces only from the rate limit headers it returns
 
 cloud_username = ""  # Your admin level username
 cloud_password = ""  # Your admin level password or app password https://support.atlassian.com/bitbucket-cloud/docs/app-passwords/
 cloud_workspace = ""  # Your workspace name/ID (just the name, not the URL) https://support.atlassian.com/bitbucket-cloud/docs/what-is-a-workspace/
+cloud_max_workers = 8  # Maximum number of concurrent requests sent to Bitbucket Cloud, keep this low to stay under the api limits
+cloud_requests_per_second = None  # Optional cap on the request rate to Bitbucket Cloud, None paces only from the rate limit headers it returns
+cloud_api_url = "https://api.bitbucket.org"  # Bitbucket Cloud's api base URL, only changed to point the tool at a stand-in api such as benchmarks/mock_bitbucket.py
+
+progress_interval = 60  # Seconds between the single line progress updates printed during a run, 0 turns them off
+connection_retries = 3  # Times a request is retried when its connection can't be opened or drops, before the run gives up on it
@@ -1,12 +1,160 @@
+import argparse
+import contextlib
+import glob
+import os
 import urllib3
+from concurrent.futures import ProcessPoolExecutor
 
+import env
 from resources.instance_init import ServerInstance, CloudInstance
 from resources.mirror_operations import ServerDetails as SD, ActionOnItems as AOI
+from resources.scan_cache import ScanCache
+from resources.checkpoint import Checkpoint
+from resources.cloud_state import CloudState
+from resources.plan import MigrationPlan
+from resources.streaming import StreamingMirror
+from resources.watch import Watcher
+from resources.group_registry import GroupRegistry
+from resources.sharding import Shard
+from resources.scope import Scope, NameFilter
+from resources.metrics import metrics
+from resources.progress import progress
+from resources.retry_queue import retry_queue
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Mirror groups, their memberships and permissions from Bitbucket Server/DC to Bitbucket Cloud.')
+    parser.add_argument('--ingest', metavar='PATH',
+                        help='Read the server structure from a directory of database table exports or a saved scan cache instead of crawling the api')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Save the server scan to FILE and reuse it on later runs instead of re-scanning the whole instance')
+    parser.add_argument('--rescan', metavar='PROJECT_KEY', nargs='+', default=[],
+                        help='Project keys to re-scan even though they are present in the scan cache')
+    parser.add_argument('--cache-max-age', metavar='HOURS', type=float,
+                        help='Re-scan cached projects that were scanned more than HOURS ago')
+    parser.add_argument('--detect-changes', action='store_true',
+                        help='Re-read the project and repo listings to pick up projects/repos added or removed since the scan cache was saved')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='Journal completed cloud writes to FILE so that an interrupted run can be resumed without repeating them')
+    parser.add_argument('--sync', action='store_true',
+                        help="Read the workspace's existing groups, memberships and repository privileges first and only write what is missing or different")
+    parser.add_argument('--failures-out', metavar='FILE', default='failures.jsonl',
+                        help='Append every group, membership and repository privilege that could not be mirrored to FILE as JSON lines (default: failures.jsonl)')
+    parser.add_argument('--retry-queue', metavar='FILE', default='retry-queue.jsonl',
+                        help='Queue the group memberships and repository group privileges that could not be mirrored yet to FILE for --retry (default: retry-queue.jsonl)')
+    parser.add_argument('--metrics-out', metavar='FILE',
+                        help='Write per endpoint request metrics to FILE, in Prometheus text format if FILE ends in .prom, otherwise as JSON')
+    scoping = parser.add_argument_group('scope', 'Limit the run to a slice of the server, e.g. one migration wave. PATTERNs are globs (e.g. "JIRA-*"), '
+                                                 'or regular expressions prefixed with "re:", matched case-insensitively')
+    for kind, name in [('projects', 'project keys'), ('repos', 'repo slugs or PROJECT_KEY/repo_slug paths'), ('groups', 'group names')]:
+        scoping.add_argument(f'--include-{kind}', metavar='PATTERN', nargs='+', help=f'Only mirror the {name} matching a PATTERN')
+        scoping.add_argument(f'--exclude-{kind}', metavar='PATTERN', nargs='+', help=f'Skip the {name} matching a PATTERN')
+    scoping.add_argument('--migrated-repos', metavar='FILE',
+                         help='Only mirror the repos listed in FILE (one PROJECT_KEY/repo_slug or repo_slug per line), e.g. the repos already migrated by BCMA')
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument('--shard', metavar='INDEX/COUNT',
+                          help='Only write the repository privileges of the projects in shard INDEX of COUNT (e.g. 0/4), to split a run between hosts. '
+                               'Shard 0 also mirrors every group and its members, the other shards wait for those groups to exist')
+    sharding.add_argument('--shards', metavar='COUNT', type=int,
+                          help='Scan the server once, then mirror it with COUNT shards run in parallel processes on this host')
+    parser.add_argument('--shard-ranges', metavar='PROJECT_KEY', nargs='+',
+                        help='Split projects between shards at these project keys (one fewer than the shard count) instead of by a hash of their key')
+    parser.add_argument('--shard-dir', metavar='DIR', default='shards',
+                        help='Directory each shard writes its summary to, and with --shards its log (default: shards)')
+    parser.add_argument('--shard-wait', metavar='MINUTES', type=float, default=60,
+                        help='How long shards other than 0 wait for shard 0 to create the groups before writing privileges anyway (default: 60)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--plan', metavar='FILE',
+                      help='Dry run: scan the server and write every cloud write that would be made to FILE without touching your cloud workspace')
+    mode.add_argument('--apply', metavar='FILE',
+                      help='Apply a plan previously written with --plan to your cloud workspace without scanning the server')
+    mode.add_argument('--where-used', metavar='GROUP', nargs='+',
+                      help='Scan the server and list the projects and repos that grant each GROUP a permission, without touching your cloud workspace')
+    mode.add_argument('--stream', action='store_true',
+                      help='Mirror each project as soon as it has been scanned instead of scanning the whole server first')
+    mode.add_argument('--merge', metavar='DIR',
+                      help='Combine the summaries written to DIR by every shard of a sharded run and print the totals')
+    mode.add_argument('--retry', action='store_true',
+                      help='Only re-attempt the items in the --retry-queue file, e.g. once more users and repos have been migrated, without scanning the server')
+    mode.add_argument('--watch', metavar='MINUTES', type=float,
+                      help='Keep running, re-scanning the server every MINUTES and pushing only the permission changes since the last scan to your cloud workspace')
+    parser.add_argument('--watch-snapshot', metavar='FILE', default='watch-snapshot.json',
+                        help='Where --watch keeps track of what it has pushed to your cloud workspace (default: watch-snapshot.json)')
+    parser.add_argument('--watch-slices', metavar='N', type=int, default=1,
+                        help='With --watch, re-read the group permissions of only 1/N of the projects and the members of 1/N of the groups on each scan, '
+                             'in turn. Changes then take up to N scans to be pushed, i.e. N x MINUTES (default: 1, everything on every scan)')
+    parser.add_argument('--revoke', action='store_true',
+                        help='With --watch, also remove group memberships and repository group privileges that were removed within Bitbucket Server')
+    args = parser.parse_args()
+    if args.stream and (args.cache or args.ingest):
+        parser.error('--stream scans the server project by project, so it cannot be combined with --cache or --ingest')
+    if args.ingest and args.apply:
+        parser.error('--apply does not read the server structure, so it cannot be combined with --ingest')
+    if args.ingest and args.cache:
+        parser.error('--ingest already reads the server structure from a file, so it cannot be combined with --cache')
+    if args.watch is not None and (args.ingest or args.checkpoint or args.sync):
+        parser.error('--watch re-scans the server and keeps its own snapshot of what was pushed, so it cannot be combined with --ingest, --checkpoint or --sync')
+    if args.revoke and args.watch is None:
+        parser.error('--revoke requires --watch')
+    if args.watch_slices < 1:
+        parser.error('--watch-slices must be at least 1')
+    try:
+        scope = open_scope(args)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.apply and scope.active:
+        parser.error('--apply writes a plan as it was scanned, limit the run with the scope options when writing the plan instead')
+    if args.retry and (scope.active or args.ingest or args.cache):
+        parser.error('--retry does not read the server, so it cannot be combined with the scope options, --ingest or --cache')
+    if args.shard or args.shards:
+        if args.plan or args.apply or args.where_used or args.stream or args.merge or args.retry or args.watch is not None:
+            parser.error('--shard/--shards can only be combined with a normal mirror run')
+        try:
+            Shard.parse(args.shard, args.shard_ranges) if args.shard else Shard(0, args.shards, args.shard_ranges)
+        except ValueError as error:
+            parser.error(str(error))
+    elif args.shard_ranges:
+        parser.error('--shard-ranges requires --shard or --shards')
+    return args
 
 
 def main() -> None:
+    args = parse_args()
+    progress.open_failure_log(args.failures_out)
+    # every run that writes to the workspace replaces the queue, sharded runs queue to one file per shard
+    replaces_queue = not (args.retry or args.plan or args.where_used or args.merge or args.shards or args.watch is not None)
+    retry_queue.open(args.retry_queue, replace=replaces_queue)
+    progress.start_reporting(getattr(env, 'progress_interval', 60))
+    if args.apply:
+        apply_plan(args)
+    elif args.retry:
+        retry_queued(args)
+    elif args.watch is not None:
+        watch(args)
+    elif args.merge:
+        merge_shards(args.merge)
+    elif args.shards:
+        run_shards(args)
+    else:
+        mirror(args)
+
+    retry_queue.close()
+    progress.stop_reporting()
+    progress.print_summary()
+    metrics.print_summary()
+    if args.metrics_out:
+        metrics.write(args.metrics_out)
+
+
+def mirror(args: argparse.Namespace) -> None:
+    shard = Shard.parse(args.shard, args.shard_ranges) if args.shard else None
     server = ServerInstance()
-    cloud = CloudInstance()
+    server.scope = open_scope(args)
+    if server.scope.active:
+        print(f'INFO: Limiting the run to {server.scope}')
+    cloud = CloudInstance() if not (args.plan or args.where_used) else None
+    if shard is not None:
+        shard.share_request_budget(server, cloud)
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning) # Hides ssl auth failure warnings if your server instance uses self-signed certs
 
     '''
@@ -16,12 +164,177 @@ def main() -> None:
     get full layout of projects/repos so that we can flatten the permissions and apply the effective permission to a given group on a given repo
     '''
 
-    groups_to_migrate, global_groups, server_structure = SD.scan_server_structure(server)
-    group_workspace_privileges = AOI.mirror_groups(server, cloud, groups_to_migrate, global_groups)
-    AOI.mirror_repo_groups(server, cloud, groups_to_migrate, server_structure)
+    if args.stream:
+        checkpoint, cloud_state = open_write_state(args, cloud)
+        summary = StreamingMirror(server, cloud, checkpoint, cloud_state).run()
+    else:
+        if args.ingest:
+            groups_to_migrate, global_groups, server_structure = SD.ingest_server_structure(args.ingest, server.scope)
+        else:
+            cache = ScanCache(args.cache, args.cache_max_age, args.rescan, args.detect_changes, server.scope.fingerprint) if args.cache else None
+            groups_to_migrate, global_groups, server_structure = SD.scan_server_structure(server, cache)
+        if args.plan:
+            MigrationPlan.write(args.plan, server, groups_to_migrate, global_groups, server_structure)
+            return
+        if args.where_used:
+            print_group_usage(groups_to_migrate, args.where_used)
+            return
+        checkpoint, cloud_state = open_write_state(args, cloud)
+        if shard is None or shard.designated:
+            summary = AOI.mirror_groups(server, cloud, groups_to_migrate, global_groups, checkpoint, cloud_state)
+        else:
+            summary = {'group_workspace_privileges': {'create_repositories': [], 'admin_workspace': []}, 'groups': 0, 'group_memberships': 0, 'skipped_memberships': {}}
+            missing = shard.wait_for_groups(cloud, groups_to_migrate, args.shard_wait * 60)
+            if missing:
+                print(f'WARN: {len(missing)} groups were not created by shard 0/{shard.count} in time, their repository privileges will likely fail: {", ".join(missing)}')
+        if shard is not None:
+            server_structure = [project for project in server_structure if shard.owns(project.key)]
+            print(f'INFO: Shard {shard} is mirroring the repository privileges of {len(server_structure)} projects')
+        summary.update(AOI.mirror_repo_groups(server, cloud, groups_to_migrate, server_structure, checkpoint, cloud_state))
+    if cloud_state is not None:
+        print(f'INFO: Sync mode skipped {cloud_state.skipped} cloud writes that were already in place')
+    if checkpoint is not None:
+        checkpoint.close()
+    if shard is not None:
+        shard.write_summary(args.shard_dir, summary)
+        print(f'INFO: Wrote the summary of shard {shard} to "{shard.summary_path(args.shard_dir)}", combine every shard\'s summary with --merge {args.shard_dir}')
+    if shard is None or shard.designated:
+        AOI.print_group_privilege_details(summary['group_workspace_privileges'], cloud.workspace)
+
+
+def run_shards(args: argparse.Namespace) -> None:
+    '''
+    Scans the server once into a scan cache, then runs every shard in its own process against that cache.
+    Without --cache the scan cache is kept in the shard directory and the server is scanned again on every run.
+    Each shard logs to its own file in the shard directory, and their summaries are merged once they have all finished.
+    '''
+    shards = [Shard(index, args.shards, args.shard_ranges) for index in range(args.shards)]
+    os.makedirs(args.shard_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(args.shard_dir, 'shard-*-of-*.json')):
+        os.remove(path) # summaries of an earlier run would otherwise be merged with this one's
+
+    server = ServerInstance()
+    server.scope = open_scope(args)
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    cache = ScanCache(args.cache or os.path.join(args.shard_dir, 'scan.jsonl'), args.cache_max_age, args.rescan, args.detect_changes,
+                      server.scope.fingerprint)
+    if not args.cache and os.path.exists(cache.path):
+        os.remove(cache.path) # only a cache asked for with --cache is reused, the shards' own one is replaced by a fresh scan
+    if args.ingest:
+        cache.save(*SD.ingest_server_structure(args.ingest, server.scope))
+    else:
+        SD.scan_server_structure(server, cache)
+
+    progress.stop_reporting() # the shards report their own progress, and no thread may hold its lock as they are forked
+    with ProcessPoolExecutor(max_workers=args.shards) as executor:
+        runs = []
+        for shard in shards:
+            shard_args = argparse.Namespace(**{**vars(args), 'shard': str(shard), 'shards': None, 'ingest': None, 'cache': cache.path, 'rescan': [], 'cache_max_age': None,
+                                               'detect_changes': False, 'checkpoint': shard.path(args.checkpoint) if args.checkpoint else None,
+                                               'metrics_out': shard.path(args.metrics_out) if args.metrics_out else None,
+                                               'failures_out': shard.path(args.failures_out), 'retry_queue': shard.path(args.retry_queue)})
+            log_path = os.path.join(args.shard_dir, f'shard-{shard.index}-of-{shard.count}.log')
+            runs.append(executor.submit(run_shard, shard_args, log_path))
+            print(f'INFO: Started shard {shard}, logging to "{log_path}"')
+        for shard, run in zip(shards, runs):
+            run.result()
+            print(f'INFO: Shard {shard} finished')
+    merge_shards(args.shard_dir)
+
+
+def run_shard(args: argparse.Namespace, log_path: str) -> None:
+    # Runs one shard within a worker process of run_shards
+    with open(log_path, 'w', encoding='utf-8') as log_file, contextlib.redirect_stdout(log_file):
+        metrics.clear() # requests made by the parent process before it was forked
+        progress.clear()
+        progress.open_failure_log(args.failures_out)
+        retry_queue.open(args.retry_queue, replace=True)
+        progress.start_reporting(getattr(env, 'progress_interval', 60))
+        mirror(args)
+        retry_queue.close()
+        progress.stop_reporting()
+        progress.print_summary()
+        metrics.print_summary()
+        if args.metrics_out:
+            metrics.write(args.metrics_out)
+
+
+def merge_shards(directory: str) -> None:
+    summary, shards, count = Shard.merge_summaries(directory)
+    if not shards:
+        exit(f'FATAL: No shard summaries were found in "{directory}". Closing...')
+    print(f'\n\nINFO: Merged the summaries of {len(shards)} of {count} shards from "{directory}"')
+    missing = sorted(set(range(count)) - set(shards))
+    if missing:
+        print(f'WARN: No summary was found for shards {", ".join(f"{index}/{count}" for index in missing)}, the totals below are incomplete.')
+    AOI.report_group_totals(summary['groups'], summary['group_memberships'], summary['skipped_memberships'])
+    print(f'INFO: Successfully mirrored the groups/permissions for {summary["successful_repos"]} of {summary["total_repos"]} repositories.')
+    AOI.print_group_privilege_details(summary['group_workspace_privileges'], env.cloud_workspace)
+
+
+def apply_plan(args: argparse.Namespace) -> None:
+    cloud = CloudInstance()
+    checkpoint, cloud_state = open_write_state(args, cloud)
+    group_workspace_privileges = MigrationPlan.apply(args.apply, cloud, checkpoint, cloud_state)
+    if cloud_state is not None:
+        print(f'INFO: Sync mode skipped {cloud_state.skipped} cloud writes that were already in place')
+    if checkpoint is not None:
+        checkpoint.close()
     AOI.print_group_privilege_details(group_workspace_privileges, cloud.workspace)
 
 
+def retry_queued(args: argparse.Namespace) -> None:
+    if not os.path.exists(args.retry_queue):
+        exit(f'FATAL: No retry queue was found at "{args.retry_queue}". Closing...')
+    cloud = CloudInstance()
+    checkpoint, cloud_state = open_write_state(args, cloud)
+    AOI.retry_queued(cloud, retry_queue, checkpoint, cloud_state)
+    if cloud_state is not None:
+        print(f'INFO: Sync mode skipped {cloud_state.skipped} cloud writes that were already in place')
+    if checkpoint is not None:
+        checkpoint.close()
+
+
+def watch(args: argparse.Namespace) -> None:
+    server = ServerInstance()
+    server.scope = open_scope(args)
+    cloud = CloudInstance()
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    # every scan re-reads the group permissions and members of all projects and groups, or of one of --watch-slices in turn
+    cache = ScanCache(args.cache or 'watch-scan.jsonl', args.cache_max_age, args.rescan, detect_changes=True, scope=server.scope.fingerprint)
+    try:
+        Watcher(server, cloud, args.watch_snapshot, args.watch * 60, args.revoke, cache, args.watch_slices).run()
+    except KeyboardInterrupt:
+        print(f'INFO: Stopped watching, the next --watch run will carry on from "{args.watch_snapshot}"')
+
+
+def print_group_usage(groups_to_migrate: GroupRegistry, group_names: list[str]) -> None:
+    for group_name in group_names:
+        if group_name not in groups_to_migrate:
+            print(f'\n----- "{group_name}" ----- is not granted any permission within Bitbucket Server and would not be migrated')
+            continue
+        usage = groups_to_migrate.usage(group_name)
+        global_permission = groups_to_migrate.global_permission(group_name)
+        print(f'\n----- "{group_name}" ----- global permission: {global_permission or "None"}, '
+              f'used by {len(usage["projects"])} projects and {len(usage["repos"])} repos')
+        print('Projects: ' + (', '.join(usage['projects']) or '-'))
+        print('Repos: ' + (', '.join(usage['repos']) or '-'))
+
+
+def open_scope(args: argparse.Namespace) -> Scope:
+    migrated_repos = Scope.read_repo_list(args.migrated_repos) if args.migrated_repos else None
+    return Scope(NameFilter(args.include_projects, args.exclude_projects), NameFilter(args.include_repos, args.exclude_repos),
+                 NameFilter(args.include_groups, args.exclude_groups), migrated_repos)
+
+
+def open_write_state(args: argparse.Namespace, cloud: CloudInstance) -> tuple[Checkpoint, CloudState]:
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+    if checkpoint is not None and len(checkpoint):
+        print(f'INFO: Resuming from checkpoint "{args.checkpoint}", skipping {len(checkpoint)} previously completed cloud writes')
+    cloud_state = CloudState.load(cloud) if args.sync else None
+    return checkpoint, cloud_state
+
+
 if __name__ == '__main__':
     main()
     exit()
@@ -0,0 +1,52 @@
+from threading import Lock
+from typing import Callable
+import json
+import os
+
+
+class Checkpoint:
+    '''
+    Append-only journal of the cloud writes that have completed successfully, keyed by (operation, *targets)
+    e.g. ("add_member_to_group", "developers", "jane@example.com").
+
+    Every record is flushed and fsync'd before the write is reported as done so that an interrupted run can be
+    restarted with the same journal and skip straight past the work it already finished.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.completed = set()
+        self.lock = Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        self.completed.add(tuple(json.loads(line)))
+                    except json.JSONDecodeError:
+                        # the last line may have been cut short if the previous run was killed mid-write
+                        continue
+        self.journal = open(path, 'a', encoding='utf-8')
+
+    def done(self, *key: str) -> bool:
+        return key in self.completed
+
+    def record(self, *key: str) -> None:
+        with self.lock:
+            self.journal.write(json.dumps(key) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.completed.add(key)
+
+    def run(self, key: tuple, write: Callable[..., bool], *args) -> bool:
+        '''Calls "write" unless "key" was already completed, recording it once "write" reports success'''
+        if self.done(*key):
+            return True
+        success = write(*args)
+        if success:
+            self.record(*key)
+        return success
+
+    def close(self) -> None:
+        self.journal.close()
+
+    def __len__(self) -> int:
+        return len(self.completed)
@@ -0,0 +1,64 @@
+from resources.instance_actions import CloudActions as CA
+from resources.instance_init import CloudInstance
+from resources.member_index import WorkspaceMemberIndex
+from threading import Lock
+
+
+class CloudState:
+    '''
+    In-memory index of the groups, group memberships and repository group privileges already present in the workspace.
+
+    Used by sync mode to skip any cloud write whose outcome is already in place. Writes are looked up with the same
+    (operation, *targets) keys that are journaled by resources/checkpoint.py. Groups are matched on either their cloud
+    name or slug. The groups api lists members by account rather than email address, so server users are matched to
+    their workspace account (uuid or account id) through the WorkspaceMemberIndex given to use_member_index.
+    '''
+    def __init__(self, groups: list[dict], privileges: list[dict]):
+        self.group_permissions = {}
+        self.group_members = {}
+        for group_data in groups:
+            members = set()
+            for member in group_data.get('members', []):
+                members.update({member.get('uuid'), member.get('account_id'), (member.get('email') or '').lower()} - {None, ''})
+            for identifier in {group_data.get('name'), group_data.get('slug')} - {None}:
+                self.group_permissions[identifier] = group_data.get('permission')
+                self.group_members[identifier] = members
+
+        self.repo_privileges = {}
+        for privilege_data in privileges:
+            repo_slug = privilege_data.get('repo', '').split('/')[-1]
+            group_data = privilege_data.get('group') or {}
+            for identifier in {group_data.get('name'), group_data.get('slug')} - {None}:
+                self.repo_privileges[(repo_slug, identifier)] = privilege_data.get('privilege')
+
+        self.member_index = None
+        self.skipped = 0
+        self.lock = Lock()
+
+    @classmethod
+    def load(cls, cloud: CloudInstance) -> 'CloudState':
+        state = cls(CA.get_groups(cloud), CA.get_group_privileges(cloud))
+        print(f'INFO: Loaded {len(state.group_members)} groups and {len(state.repo_privileges)} repository group privileges from your cloud workspace')
+        return state
+
+    def use_member_index(self, member_index: WorkspaceMemberIndex) -> None:
+        # the index must be loaded with the members' emails before their memberships are looked up
+        member_index.resolve_accounts = True
+        self.member_index = member_index
+
+    def done(self, operation: str, group_name: str, *targets: str) -> bool:
+        if operation == 'create_group':
+            present = group_name in self.group_members
+        elif operation == 'set_group_global_access':
+            present = self.group_permissions.get(group_name) == targets[0]
+        elif operation == 'add_member_to_group':
+            members = self.group_members.get(group_name, set())
+            present = (targets[0] or '').lower() in members or bool(self.member_index is not None and self.member_index.account_ids(targets[0]) & members)
+        elif operation == 'add_group_to_repo':
+            present = self.repo_privileges.get((targets[0], group_name)) == targets[1]
+        else:
+            present = False
+        if present:
+            with self.lock:
+                self.skipped += 1
+        return present
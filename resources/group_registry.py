@@ -0,0 +1,74 @@
+from resources.instance_actions import GlobalGroup, Project, intern
+from collections import defaultdict
+from collections.abc import Sequence
+from typing import Iterable, Iterator
+
+
+class GroupRegistry(Sequence):
+    '''
+    The groups to migrate, in the order they were discovered: global groups first, then the groups granted on each
+    project and its repos. Behaves as the list of group names it replaces, with O(1) membership checks.
+
+    Each group's global permission is held by name, the first one listed for a group winning as it would with a linear
+    lookup. With "track_usage" every registered project also fills reverse indexes of the projects and repos that grant
+    each group, so "where is group X used" can be answered without walking the server structure again.
+    '''
+    def __init__(self, global_groups: Iterable[GlobalGroup]=(), track_usage: bool=True):
+        self.names = []
+        self.known = set()
+        self.global_permissions = {}
+        self.track_usage = track_usage
+        self.project_usage = defaultdict(set)
+        self.repo_usage = defaultdict(set)
+        for group in global_groups:
+            self.add_global(group)
+
+    def add(self, group_name: str) -> bool:
+        '''returns True when the group had not been seen before'''
+        if group_name in self.known:
+            return False
+        group_name = intern(group_name)
+        self.known.add(group_name)
+        self.names.append(group_name)
+        return True
+
+    def add_global(self, group: GlobalGroup) -> None:
+        self.global_permissions.setdefault(intern(group.name), group.permission)
+        self.add(group.name)
+
+    def register(self, project: Project) -> list[str]:
+        '''Adds every group granted on "project" or its repos, returns the ones not seen before'''
+        new_groups = [group.name for group in project.groups if self.add(group.name)]
+        if self.track_usage:
+            for group in project.groups:
+                self.project_usage[group.name].add(project.key)
+        for repo in project.repositories:
+            new_groups += [group.name for group in repo.groups if self.add(group.name)]
+            if self.track_usage:
+                for group in repo.groups:
+                    self.repo_usage[group.name].add((project.key, repo.slug))
+        return new_groups
+
+    def global_permission(self, group_name: str) -> str:
+        '''returns the group's Server global permission, None when it isn't a global group'''
+        return self.global_permissions.get(group_name)
+
+    def is_global(self, group_name: str) -> bool:
+        return group_name in self.global_permissions
+
+    def usage(self, group_name: str) -> dict:
+        '''returns the keys of the projects and the "PROJECT/repo" paths of the repos that grant the group a permission'''
+        return {'projects': sorted(self.project_usage.get(group_name, ())),
+                'repos': [f'{project_key}/{repo_slug}' for project_key, repo_slug in sorted(self.repo_usage.get(group_name, ()))]}
+
+    def __getitem__(self, index):
+        return self.names[index]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, group_name: str) -> bool:
+        return group_name in self.known
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
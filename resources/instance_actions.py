@@ -1,20 +1,33 @@
 from resources.instance_init import ServerInstance, CloudInstance
+from requests import Response
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import Generator
+import sys
 
-@dataclass
+# Models are slotted where supported (python 3.10+) so that each of the many scanned instances carries no __dict__,
+# and the group names and permission strings repeated across every project/repo are interned to a single copy
+model = dataclass(**({'slots': True} if sys.version_info >= (3, 10) else {}))
+
+def intern(value: str) -> str:
+    return sys.intern(value) if isinstance(value, str) else value
+
+@model
 class User:
     name: str
     emailAddress: str
     displayName: str
     slug: str
 
-@dataclass
+@model
 class GlobalGroup:
     name: str
     permission: str
 
-@dataclass
+    def __post_init__(self):
+        self.name, self.permission = intern(self.name), intern(self.permission)
+
+@model
 class Project:
     key: str
     name: str
@@ -23,94 +36,95 @@ class Project:
     groups: list = field(default_factory=lambda: [])
     repositories: list = field(default_factory=lambda: [])
 
-@dataclass
+    def __post_init__(self):
+        self.default_permission = intern(self.default_permission)
+
+@model
 class Group:
     name: str
     permission: str = None
 
-@dataclass
+    def __post_init__(self):
+        self.name, self.permission = intern(self.name), intern(self.permission)
+
+@model
 class Repository:
     slug: str
     name: str
     default_permission: str
     groups: list = field(default_factory=lambda: [])
 
-class ServerActions(ServerInstance):
-    @staticmethod
-    def paged(page=None):
-        if page == None:
-            page = 1
-        page += 1
+    def __post_init__(self):
+        self.default_permission = intern(self.default_permission)
 
-    def get_group_global_permissions(self, page=None, limit=1_000) -> Generator[GlobalGroup, None, None]:
-        # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp63
-        while True:
-            params = {'page': page, 'limit': limit}
-            endpoint = f'{self.api}/admin/permissions/groups'
+class ServerActions(ServerInstance):
+    def paged(self, endpoint: str, params: dict=None, limit: int=1_000, prefetch: bool=True) -> Generator[dict, None, None]:
+        '''
+        Streams the "values" of every page from a paged api by following the start/nextPageStart cursor
+        https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#paging-params
+        With prefetch the following page is requested while the current page is being consumed.
+        A page that still fails once its retries are used up stops the run, see checked.
+        '''
+        params = {**(params or {}), 'start': 0, 'limit': limit}
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
             r = self.get_api(endpoint, params=params)
-            r_json = r.json()
-            for group_data in r_json['values']:
-                group = GlobalGroup(group_data.get('group').get('name'), group_data.get('permission'))
-                yield group
+            while True:
+                r_json = ServerActions.checked(r).json()
+                if r_json.get('isLastPage', True) or r_json.get('nextPageStart') is None:
+                    yield from r_json.get('values', [])
+                    return
 
-            if not r_json.get('nextPageStart'):
-                return
+                params = {**params, 'start': r_json.get('nextPageStart')}
+                following = prefetcher.submit(self.get_api, endpoint, params) if prefetch else None
+                yield from r_json.get('values', [])
+                r = following.result() if prefetch else self.get_api(endpoint, params=params)
+
+    @staticmethod
+    def checked(r: Response) -> Response:
+        # A scan request still failing once its retries are used up stops the run, as carrying on would silently leave
+        # permissions out of the scan, the scan cache and the watch mode's snapshot
+        if r.status_code != 200:
+            exit(f'FATAL: Could not read {r.url} error: HTTP {r.status_code}, stopping rather than mirroring an incomplete scan. Closing...')
+        return r
 
-            page = self.paged(page)
+    def get_group_global_permissions(self, limit=1_000) -> Generator[GlobalGroup, None, None]:
+        # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp63
+        endpoint = f'{self.api}/admin/permissions/groups'
+        for group_data in ServerActions.paged(self, endpoint, limit=limit):
+            if not self.scope.includes_group(group_data.get('group').get('name')):
+                continue
+            group = GlobalGroup(group_data.get('group').get('name'), group_data.get('permission'))
+            yield group
     
-    def get_all_groups(self, page=None, limit=1_000) -> Generator[Group, None, None]:
+    def get_all_groups(self, limit=1_000) -> Generator[Group, None, None]:
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp5
-        while True:
-            params = {'page': page, 'limit': limit}
-            endpoint = f'{self.api}/admin/groups'
-            r = self.get_api(endpoint, params=params)
-            r_json = r.json()
-            for group_data in r_json['values']:
-                group = Group(group_data.get('name'))
-                yield group
+        endpoint = f'{self.api}/admin/groups'
+        for group_data in ServerActions.paged(self, endpoint, limit=limit):
+            group = Group(group_data.get('name'))
+            yield group
 
-            if not r_json.get('nextPageStart'):
-                return
-
-            page = self.paged(page)
-
-    def get_group_members(self, group_name: str, page=None, limit=1_000) -> Generator[User, None, None]:
+    def get_group_members(self, group_name: str, limit=1_000) -> Generator[User, None, None]:
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp11
-        while True:
-            params = {'context': group_name,'page': page, 'limit': limit}
-            endpoint = f'{self.api}/admin/groups/more-members'
-            r = self.get_api(endpoint, params=params)
-            r_json = r.json()
-            for user_data in r_json['values']:
-                user = User(user_data.get("name"), user_data.get("emailAddress"), user_data.get("displayName"), user_data.get("slug"))
-                yield user
+        endpoint = f'{self.api}/admin/groups/more-members'
+        for user_data in ServerActions.paged(self, endpoint, params={'context': group_name}, limit=limit):
+            user = User(user_data.get("name"), user_data.get("emailAddress"), user_data.get("displayName"), user_data.get("slug"))
+            yield user
 
-            if not r_json.get('nextPageStart'):
-                return
-
-            page = self.paged(page)
-
-    def get_projects(self, page=None, limit=1_000) -> Generator[Project, None, None]:
+    def get_projects(self, limit=1_000, default_permissions: bool=True) -> Generator[Project, None, None]:
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp149
-        while True:
-            params = {'page': page, 'limit': limit}
-            endpoint = f'{self.api}/projects'
-            r = self.get_api(endpoint, params=params)
-            r_json = r.json()
-            for project_data in r_json['values']:
-                project_default_permission = ServerActions.get_project_default_permission(self, project_data)
-                project = Project(project_data.get('key'), project_data.get('name'), project_data.get('public'), project_default_permission)
-                yield project
-
-            if not r_json.get('nextPageStart'):
-                return
-
-            page = self.paged(page)
+        # Without default_permissions the projects' default permission is left as None for the caller to request
+        endpoint = f'{self.api}/projects'
+        for project_data in ServerActions.paged(self, endpoint, limit=limit):
+            if not self.scope.includes_project(project_data.get('key')):
+                continue # skipped before its default permission is requested
+            project_default_permission = ServerActions.get_project_default_permission(self, project_data) if default_permissions else None
+            project = Project(project_data.get('key'), project_data.get('name'), project_data.get('public'), project_default_permission)
+            yield project
     
     def get_project_default_permission(self, project: dict) -> str:
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp171
         endpoint = f'{self.api}/projects/{project.get("key")}/permissions/project_write/all'
-        r = self.get_api(endpoint)
+        r = ServerActions.checked(self.get_api(endpoint))
         r_json = r.json()
         if r_json.get('permitted') == True:
             default_permission = "Write"
@@ -119,7 +133,7 @@ class ServerActions(ServerInstance):
                 default_permission = "Read"
             else:
                 endpoint = f'{self.api}/projects/{project.get("key")}/permissions/project_read/all'
-                r = self.get_api(endpoint)
+                r = ServerActions.checked(self.get_api(endpoint))
                 r_json = r.json()
                 if r_json.get('permitted') == True:
                     default_permission = "Read"
@@ -127,59 +141,57 @@ class ServerActions(ServerInstance):
                     default_permission = "None"
         return default_permission
 
-    def get_project_groups(self, project: Project, page=None, limit=1_000) -> Generator[Group, None, None]:
+    def get_project_groups(self, project: Project, limit=1_000) -> Generator[Group, None, None]:
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp159
-        while True:
-            params = {'page': page, 'limit': limit}
-            endpoint = f'{self.api}/projects/{project.key}/permissions/groups'
-            r = self.get_api(endpoint, params=params)
-            r_json = r.json()
-            for group_data in r_json['values']:
-                group = Group(group_data.get('group').get('name'), group_data.get('permission'))
-                yield group
-
-            if not r_json.get('nextPageStart'):
-                return
+        endpoint = f'{self.api}/projects/{project.key}/permissions/groups'
+        for group_data in ServerActions.paged(self, endpoint, limit=limit):
+            if not self.scope.includes_group(group_data.get('group').get('name')):
+                continue
+            group = Group(group_data.get('group').get('name'), group_data.get('permission'))
+            yield group
 
-            page = self.paged(page)
-
-    def get_repos(self, project: Project, page=None, limit=1_000) -> Generator[Repository, None, None]:
+    def get_repos(self, project: Project, limit=1_000) -> Generator[Repository, None, None]:
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp175
-        while True:
-            params = {'page': page, 'limit': limit}
-            endpoint = f'{self.api}/projects/{project.key}/repos'
-            r = self.get_api(endpoint, params=params)
-            r_json = r.json()
-            for repo_data in r_json['values']:
-                if repo_data.get('public') == True:
-                    repo_default_permission = "Read"
-                else:
-                    repo_default_permission = "None"
-                repo = Repository(repo_data.get('slug'), repo_data.get('name'), repo_default_permission)
-                yield repo
-
-            if not r_json.get('nextPageStart'):
-                return
-
-            page = self.paged(page)
+        endpoint = f'{self.api}/projects/{project.key}/repos'
+        for repo_data in ServerActions.paged(self, endpoint, limit=limit):
+            if not self.scope.includes_repo(project.key, repo_data.get('slug')):
+                continue # skipped before its groups are requested
+            if repo_data.get('public') == True:
+                repo_default_permission = "Read"
+            else:
+                repo_default_permission = "None"
+            repo = Repository(repo_data.get('slug'), repo_data.get('name'), repo_default_permission)
+            yield repo
 
-    def get_repo_groups(self, project: Project, repo: Repository, page=None, limit=1_000) -> Generator[Group, None, None]:
+    def get_repo_groups(self, project: Project, repo: Repository, limit=1_000) -> Generator[Group, None, None]:
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp282
+        endpoint = f'{self.api}/projects/{project.key}/repos/{repo.slug}/permissions/groups'
+        for group_data in ServerActions.paged(self, endpoint, limit=limit):
+            if not self.scope.includes_group(group_data.get('group').get('name')):
+                continue
+            group = Group(group_data.get('group').get('name'), group_data.get('permission'))
+            yield group
+
+class CloudActions(CloudInstance):
+    def paged(self, endpoint: str, params: dict=None) -> Generator[dict, None, None]:
+        '''
+        Streams the "values" of every page from a 2.0 paged api by following the "next" link
+        https://developer.atlassian.com/cloud/bitbucket/rest/intro/#pagination
+        A page that still fails once its retries are used up stops the run, as a partial listing would e.g. leave
+        migrated repos out and skip their privileges as if they had not been migrated yet.
+        '''
+        r = self.get_api(endpoint, params=params)
         while True:
-            params = {'page': page, 'limit': limit}
-            endpoint = f'{self.api}/projects/{project.key}/repos/{repo.slug}/permissions/groups'
-            r = self.get_api(endpoint, params=params)
+            if r.status_code != 200:
+                exit(f'FATAL: Could not list {r.url} error: HTTP {r.status_code}, stopping rather than working from an incomplete listing. Closing...')
             r_json = r.json()
-            for group_data in r_json['values']:
-                group = Group(group_data.get('group').get('name'), group_data.get('permission'))
-                yield group
+            yield from r_json.get('values', [])
 
-            if not r_json.get('nextPageStart'):
+            if not r_json.get('next'):
                 return
+            # the "next" link already carries the original query params
+            r = self.get_api(r_json.get('next'))
 
-            page = self.paged(page)
-
-class CloudActions(CloudInstance):
     def create_group(self, group_name: str) -> bool:
         # https://support.atlassian.com/bitbucket-cloud/docs/groups-endpoint/
         payload = f'name={group_name}'
@@ -194,6 +206,17 @@ class CloudActions(CloudInstance):
         else:
             return False
 
+    def get_groups(self) -> list[dict]:
+        # https://support.atlassian.com/bitbucket-cloud/docs/groups-endpoint/
+        '''
+        returns every group in the workspace along with its members and default permission
+        '''
+        endpoint = f'{self.api}/1.0/groups/{self.workspace}'
+        r = self.get_api(endpoint)
+        if r.status_code == 200:
+            return r.json()
+        return []
+
     def set_group_global_access(self, group_name: str, permission: str) -> bool:
         # https://support.atlassian.com/bitbucket-cloud/docs/groups-endpoint/
         '''
@@ -220,6 +243,34 @@ class CloudActions(CloudInstance):
         # 404 is thrown if the user isn't within the workspace yet
         return False
 
+    def remove_member_from_group(self, group: str, email: str) -> bool:
+        # https://support.atlassian.com/bitbucket-cloud/docs/groups-endpoint/
+        endpoint = f'{self.api}/1.0/groups/{self.workspace}/{group}/members/{email}/'
+        r = self.delete_api(endpoint)
+        # 404 is thrown if the user is already not in the group
+        return r.status_code in (200, 204, 404)
+
+    def find_workspace_members(self, emails: list[str]) -> list[dict]:
+        # https://developer.atlassian.com/cloud/bitbucket/rest/api-group-workspaces/#api-workspaces-workspace-members-get
+        '''
+        returns the workspace memberships of the users with the given email addresses,
+        or None when the workspace can't be filtered by email (requires workspace admin)
+        '''
+        endpoint = f'{self.api}/2.0/workspaces/{self.workspace}/members'
+        emails_filter = ', '.join(f'"{email}"' for email in emails)
+        params = {'q': f'user.email IN ({emails_filter})', 'pagelen': 100}
+        r = self.get_api(endpoint, params=params)
+        members = []
+        while True:
+            if r.status_code != 200:
+                return None
+            r_json = r.json()
+            members.extend(r_json.get('values', []))
+
+            if not r_json.get('next'):
+                return members
+            r = self.get_api(r_json.get('next'))
+
     def verify_repo_exists(self, repo_slug: str) -> bool:
         # https://developer.atlassian.com/bitbucket/api/2/reference/resource/repositories/%7Bworkspace%7D/%7Brepo_slug%7D#get
         endpoint = f'{self.api}/2.0/repositories/{self.workspace}/{repo_slug}'
@@ -228,6 +279,23 @@ class CloudActions(CloudInstance):
             return True
         return False
 
+    def get_repo_slugs(self, pagelen: int=100) -> set[str]:
+        # https://developer.atlassian.com/cloud/bitbucket/rest/api-group-repositories/#api-repositories-workspace-get
+        endpoint = f'{self.api}/2.0/repositories/{self.workspace}'
+        params = {'pagelen': pagelen, 'fields': 'next,values.slug'}
+        return {repo_data.get('slug') for repo_data in CloudActions.paged(self, endpoint, params=params)}
+
+    def get_group_privileges(self) -> list[dict]:
+        # https://support.atlassian.com/bitbucket-cloud/docs/group-privileges-endpoint/
+        '''
+        returns the group privileges of every repository in the workspace
+        '''
+        endpoint = f'{self.api}/1.0/group-privileges/{self.workspace}'
+        r = self.get_api(endpoint)
+        if r.status_code == 200:
+            return r.json()
+        return []
+
     def add_group_to_repo(self, repo_slug: str, group_name: str, flattened_permission: str) -> bool:
         # https://support.atlassian.com/bitbucket-cloud/docs/group-privileges-endpoint/
         payload = flattened_permission
@@ -236,3 +304,10 @@ class CloudActions(CloudInstance):
         if r.status_code == 200:
             return True
         return False
+
+    def remove_group_from_repo(self, repo_slug: str, group_name: str) -> bool:
+        # https://support.atlassian.com/bitbucket-cloud/docs/group-privileges-endpoint/
+        endpoint = f'{self.api}/1.0/group-privileges/{self.workspace}/{repo_slug}/{self.workspace}/{group_name}'
+        r = self.delete_api(endpoint)
+        # 404 is thrown if the group has no privilege on the repo, or the repo is gone
+        return r.status_code in (200, 204, 404)
@@ -1,7 +1,15 @@
 from requests import Session, Response
+from requests.adapters import HTTPAdapter
 from requests.exceptions import SSLError
-from time import sleep
+from requests.utils import get_environ_proxies
+from urllib3.util.retry import Retry
+from threading import BoundedSemaphore
+from time import perf_counter, sleep
+from resources.metrics import metrics, endpoint_template, SERVER_PATH_VARIABLES, CLOUD_PATH_VARIABLES
+from resources.rate_limiter import RateLimiter
+from resources.scope import Scope
 import env
+import os
 
 class Instance():
     def __new__(cls, *args, **kwargs):
@@ -9,19 +17,74 @@ class Instance():
             raise TypeError("base class may not be instantiated")
         return object.__new__(cls, *args, **kwargs)
 
+    def open_session(self, url: str, auth: tuple) -> Session:
+        '''
+        Builds the keep-alive session used for every request to one host.
+        Its connection pool holds a connection per worker, so concurrent requests reuse established (TLS) connections
+        rather than opening and discarding extra ones past the default pool of 10. Connections that fail to open,
+        and idempotent requests whose connection drops, are retried at the transport level; 429/5xx responses are
+        left to the rate limiter. Responses are gzip/deflate encoded as requests negotiates by default.
+        '''
+        session = Session()
+        session.auth = auth
+        session.headers.update({'Accept': 'application/json', 'Content-type': 'application/json'})
+        connection_retries = getattr(env, 'connection_retries', 3)
+        retries = Retry(total=None, connect=connection_retries, read=connection_retries, status=0, other=0, backoff_factor=0.5, raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=self.max_workers, pool_block=True, max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        # requests otherwise re-reads the proxy and CA bundle settings from the environment for every single request,
+        # they're resolved once as each session only talks to a single host
+        session.proxies.update(get_environ_proxies(url))
+        session.verify = os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE') or True
+        session.trust_env = False
+        return session
+
+    def set_share(self, share: float) -> None:
+        '''
+        Keeps to "share" of the request budget, for when several processes send requests with the same account:
+        the requests per second, the workers and the requests in flight are all cut to that share, at least 1 each
+        '''
+        self.max_workers = max(1, int(self.max_workers * share))
+        self.request_slots = BoundedSemaphore(self.max_workers)
+        self.rate_limiter.set_share(share)
+
     @staticmethod
     def verify_session(verify_api_endpoint: str, session: Session) -> None:
         r = session.get(verify_api_endpoint)
         if Instance.authorized(r.status_code) and r.status_code >= 400:
             exit(f'FATAL: Could not successfully interact with the api at {verify_api_endpoint} error: HTTP {r.status_code}. Closing...')
 
-    @staticmethod
-    def rate_limited(status_code: int) -> bool:
-        if status_code == 429:
-            print('WARN: Hit api rate limit, sleeping for 1 minute then attempting to resume...')
-            sleep(60)
-            return True
-        return False
+    def send(self, method: str, endpoint: str, **kwargs) -> Response:
+        # Every api call funnels through here so that pacing, retries, the concurrency cap and instrumentation are shared per host
+        template = endpoint_template(endpoint, self.api, self.path_variables)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            with self.request_slots:
+                started = perf_counter()
+                r = self.session.request(method, endpoint, **kwargs)
+                latency = perf_counter() - started
+            self.rate_limiter.observe(r)
+            body = r.request.body or b''
+            metrics.record(self.host, method, template, r.status_code, latency,
+                           len(body if isinstance(body, bytes) else body.encode()), len(r.content))
+
+            if not self.rate_limited(r, attempt, template) and self.authorized(r.status_code):
+                return r
+            attempt += 1
+
+    def rate_limited(self, r: Response, attempt: int, template: str=None) -> bool:
+        if not self.rate_limiter.should_retry(r.status_code, attempt):
+            return False
+        delay = self.rate_limiter.backoff(r, attempt)
+        metrics.record_retry(self.host, r.request.method, template or r.url, delay, r.status_code == 429)
+        if r.status_code == 429:
+            print(f'WARN: Hit api rate limit, pausing requests for {delay:.1f} seconds then attempting to resume...')
+        else:
+            print(f'WARN: Received HTTP {r.status_code} from {r.url}, retrying in {delay:.1f} seconds...')
+        sleep(delay)
+        return True
 
     @staticmethod
     def authorized(status_code: int) -> bool:
@@ -36,15 +99,20 @@ class Instance():
 
 
 class ServerInstance(Instance):
+    host = 'server'
+    path_variables = SERVER_PATH_VARIABLES
+
     def __init__(self):
         self.username = env.server_username
         self.password = env.server_password
         self.url = env.server_url
         self.api = f'{self.url}/rest/api/latest'
-        self.ssl_verified = True
-        self.session = Session()
-        self.session.auth = (self.username, self.password)
-        self.session.headers.update({'Accept': 'application/json', 'Content-type': 'application/json'})
+        self.max_workers = getattr(env, 'server_max_workers', 8)
+        self.request_slots = BoundedSemaphore(self.max_workers)
+        self.rate_limiter = RateLimiter(getattr(env, 'server_requests_per_second', None))
+        # Everything is scanned unless the run is limited to a slice of the instance
+        self.scope = Scope()
+        self.session = self.open_session(self.url, (self.username, self.password))
         self._verify_url()
         # https://docs.atlassian.com/bitbucket-server/rest/7.15.1/bitbucket-rest.html#idp45
         self.verify_session(f'{self.api}/admin/cluster', self.session)
@@ -53,56 +121,48 @@ class ServerInstance(Instance):
         try:
             r = self.get_api(f'{self.url}/status')
         except SSLError:
-            self.ssl_verified = False # Using https but ssl cert is self-signed or other issue, ignorable
+            self.session.verify = False # Using https but ssl cert is self-signed or other issue, ignorable
             r = self.get_api(f'{self.url}/status')
 
         if not "RUNNING" in r.text:
             exit(f'FATAL: Did not get a "RUNNING" response from the url "{self.url}/status", cannot continue. Closing...')
 
     def get_api(self, endpoint: str, params: dict=None) -> Response:
-        while True:
-            r = self.session.get(endpoint, params=params, verify=self.ssl_verified)
-
-            if not self.rate_limited(r.status_code) and self.authorized(r.status_code):
-                return r
+        return self.send('GET', endpoint, params=params)
 
 
 class CloudInstance(Instance):
+    host = 'cloud'
+    path_variables = CLOUD_PATH_VARIABLES
+
     def __init__(self):
         self.username = env.cloud_username
         self.password = env.cloud_password
         self.workspace = env.cloud_workspace
         self.url = f"https://bitbucket.org/{self.workspace}"
-        self.api = "https://api.bitbucket.org"
-        self.session = Session()
-        self.session.auth = (self.username, self.password)
-        self.session.headers.update({'Accept': 'application/json', 'Content-type': 'application/json'})
+        self.api = getattr(env, 'cloud_api_url', "https://api.bitbucket.org")
+        self.max_workers = getattr(env, 'cloud_max_workers', 8)
+        # Caps in-flight requests to the cloud api across every worker pool sharing this instance
+        self.request_slots = BoundedSemaphore(self.max_workers)
+        self.rate_limiter = RateLimiter(getattr(env, 'cloud_requests_per_second', None))
+        self.session = self.open_session(self.api, (self.username, self.password))
         # https://developer.atlassian.com/bitbucket/api/2/reference/resource/workspaces/%7Bworkspace%7D/permissions
         self.verify_session(f'{self.api}/2.0/workspaces/{self.workspace}/permissions', self.session)
 
     def get_api(self, endpoint: str, params: dict=None) -> Response:
-        while True:
-            r = self.session.get(endpoint, params=params)
-
-            if not self.rate_limited(r.status_code) and self.authorized(r.status_code):
-                return r
+        return self.send('GET', endpoint, params=params)
 
     def post_api(self, endpoint: str, payload: dict) -> Response:
-        while True:
-            r = self.session.post(endpoint, data=payload)
+        return self.send('POST', endpoint, data=payload)
 
-            if not self.rate_limited(r.status_code) and self.authorized(r.status_code):
-                return r
+    def delete_api(self, endpoint: str) -> Response:
+        return self.send('DELETE', endpoint)
 
     def put_api(self, endpoint: str, payload: dict, data_method: str) -> Response:
         if data_method not in ["data", "json"]:
             raise ValueError('Incorrect usage of input "data_method" arg in .resources/instance_init.py "CloudInstance.put_api"')
-        while True:
-            if data_method == "data":
-                # overwrite the default headers to plain text
-                r = self.session.put(endpoint, data=payload, headers={'Content-type': 'text/plain'})
-            else: # data_method = "json"
-                r = self.session.put(endpoint, json=payload)
-
-            if not self.rate_limited(r.status_code) and self.authorized(r.status_code):
-                return r
+        if data_method == "data":
+            # overwrite the default headers to plain text
+            return self.send('PUT', endpoint, data=payload, headers={'Content-type': 'text/plain'})
+        else: # data_method = "json"
+            return self.send('PUT', endpoint, json=payload)
@@ -0,0 +1,83 @@
+from resources.instance_actions import User, CloudActions as CA
+from resources.instance_init import CloudInstance
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Iterable
+
+
+class WorkspaceMemberIndex:
+    '''
+    Which server users (by email address) are already members of the cloud workspace.
+
+    Emails are looked up in batches through the workspace members api's "user.email IN (...)" filter. Batches that come
+    back empty or complete resolve every email in them. When only some of a batch's users are found and the matches
+    don't carry their email address, each email in that batch is looked up on its own, so every distinct user costs at
+    most one request. Emails that couldn't be resolved, e.g. when the filter isn't available, are reported as unknown
+    so that their memberships are still attempted as usual.
+
+    With "resolve_accounts" (set by sync mode, see resources/cloud_state.py) the workspace account of every member is
+    kept too, so complete batches whose matches don't carry their email address are also looked up email by email.
+
+    Server users are also interned here so that a user who belongs to many groups is only held once.
+    '''
+    def __init__(self, cloud: CloudInstance, batch_size: int=50, resolve_accounts: bool=False):
+        self.cloud = cloud
+        self.batch_size = batch_size
+        self.resolve_accounts = resolve_accounts
+        self.accounts = {}
+        self.non_members = set()
+        self.users = {}
+        self.lock = Lock()
+
+    def intern(self, user: User) -> User:
+        with self.lock:
+            return self.users.setdefault(user.name, user)
+
+    def load(self, emails: Iterable[str]) -> None:
+        emails = sorted({email.lower() for email in emails if email and '"' not in email} - self.accounts.keys() - self.non_members)
+        batches = [emails[start:start + self.batch_size] for start in range(0, len(emails), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.cloud.max_workers) as executor:
+            list(executor.map(self._resolve, batches))
+        print(f'INFO: Found {sum(email in self.accounts for email in emails)} of {len(emails)} group members within your cloud workspace')
+
+    def is_member(self, email: str) -> bool:
+        '''returns True/False when the email's workspace membership is known, otherwise None'''
+        email = (email or '').lower()
+        if email in self.accounts:
+            return True
+        if email in self.non_members:
+            return False
+        return None
+
+    def account_ids(self, email: str) -> set[str]:
+        '''returns the uuid and account id of the email's workspace account, empty when it isn't known'''
+        account = self.accounts.get((email or '').lower()) or {}
+        return {account.get('uuid'), account.get('account_id')} - {None}
+
+    def _resolve(self, emails: list[str]) -> None:
+        members = CA.find_workspace_members(self.cloud, emails)
+        if members is None or len(members) > len(emails):
+            # the api didn't apply the filter, leave these emails unknown
+            return
+        matched = {((member.get('user') or {}).get('email') or '').lower(): member.get('user') for member in members}
+        with self.lock:
+            if not members:
+                self.non_members.update(emails)
+                return
+            if len(emails) == 1:
+                self.accounts[emails[0]] = members[0].get('user') or {}
+                return
+            if len(members) == len(emails) and ('' not in matched or not self.resolve_accounts):
+                for email in emails:
+                    self.accounts[email] = matched.get(email, {})
+                return
+            if '' not in matched:
+                # every match carried its email address
+                for email in emails:
+                    if email in matched:
+                        self.accounts[email] = matched[email]
+                    else:
+                        self.non_members.add(email)
+                return
+        for email in emails:
+            self._resolve([email])
@@ -0,0 +1,149 @@
+from collections import Counter, defaultdict
+from threading import Lock
+from urllib.parse import urlsplit
+import json
+import math
+
+
+# Path segments that are followed by variable values, and the placeholders those values are reported as
+SERVER_PATH_VARIABLES = {'projects': ('{key}',), 'repos': ('{slug}',)}
+CLOUD_PATH_VARIABLES = {
+    'workspaces': ('{workspace}',),
+    'repositories': ('{workspace}', '{slug}'),
+    'groups': ('{workspace}', '{group}'),
+    'members': ('{email}',),
+    'group-privileges': ('{workspace}', '{repo}', '{owner}', '{group}'),
+}
+
+
+def endpoint_template(url: str, base_url: str, path_variables: dict) -> str:
+    '''
+    Reduces a request url to its endpoint template
+    e.g. https://bb.example.com/rest/api/latest/projects/PRJ/repos/app/permissions/groups -> /projects/{key}/repos/{slug}/permissions/groups
+    '''
+    path = urlsplit(url).path
+    base_path = urlsplit(base_url).path.rstrip('/')
+    if base_path and path.startswith(base_path):
+        path = path[len(base_path):]
+    segments = [segment for segment in path.split('/') if segment]
+    template = []
+    position = 0
+    while position < len(segments):
+        segment = segments[position]
+        template.append(segment)
+        position += 1
+        for placeholder in path_variables.get(segment, ()):
+            if position >= len(segments):
+                break
+            template.append(placeholder)
+            position += 1
+    return '/' + '/'.join(template)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.statuses = Counter()
+        self.retries = 0
+        self.rate_limit_sleeps = 0
+        self.rate_limit_sleep_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = []
+
+    def percentile(self, percentile: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+    def as_dict(self) -> dict:
+        return {'requests': self.requests, 'statuses': dict(self.statuses), 'retries': self.retries,
+                'rate_limit_sleeps': self.rate_limit_sleeps, 'rate_limit_sleep_seconds': round(self.rate_limit_sleep_seconds, 3),
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'latency_seconds': {'total': round(sum(self.latencies), 6), 'p50': self.percentile(50),
+                                    'p95': self.percentile(95), 'p99': self.percentile(99), 'max': max(self.latencies, default=0.0)}}
+
+
+class RequestMetrics:
+    '''
+    Per endpoint request instrumentation shared by every instance, keyed by (host label, method, endpoint template).
+    Records request counts, status codes, retries, rate limit sleeps, bytes transferred and latencies.
+    '''
+    def __init__(self):
+        self.endpoints = defaultdict(EndpointStats)
+        self.lock = Lock()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.endpoints.clear()
+
+    def record(self, host: str, method: str, endpoint: str, status_code: int, latency: float, bytes_sent: int, bytes_received: int) -> None:
+        with self.lock:
+            stats = self.endpoints[(host, method, endpoint)]
+            stats.requests += 1
+            stats.statuses[status_code] += 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.latencies.append(latency)
+
+    def record_retry(self, host: str, method: str, endpoint: str, delay: float, rate_limited: bool) -> None:
+        with self.lock:
+            stats = self.endpoints[(host, method, endpoint)]
+            stats.retries += 1
+            if rate_limited:
+                stats.rate_limit_sleeps += 1
+                stats.rate_limit_sleep_seconds += delay
+
+    def as_dict(self) -> list[dict]:
+        with self.lock:
+            return [{'host': host, 'method': method, 'endpoint': endpoint, **stats.as_dict()}
+                    for (host, method, endpoint), stats in sorted(self.endpoints.items())]
+
+    def print_summary(self) -> None:
+        rows = self.as_dict()
+        if not rows:
+            return
+        print('\n\n----- Api request summary -----')
+        print(f'{"host":<7}{"method":<7}{"requests":>9}{"retries":>8}{"429 sec":>8}{"MB in":>8}{"p50 ms":>8}{"p95 ms":>8}{"p99 ms":>8}  endpoint')
+        for row in sorted(rows, key=lambda row: row['latency_seconds']['total'], reverse=True):
+            latency = row['latency_seconds']
+            print(f'{row["host"]:<7}{row["method"]:<7}{row["requests"]:>9}{row["retries"]:>8}{row["rate_limit_sleep_seconds"]:>8.0f}'
+                  f'{row["bytes_received"] / 1_000_000:>8.1f}{latency["p50"] * 1_000:>8.0f}{latency["p95"] * 1_000:>8.0f}{latency["p99"] * 1_000:>8.0f}'
+                  f'  {row["endpoint"]} {dict(sorted(row["statuses"].items()))}')
+
+    def write(self, path: str) -> None:
+        '''Writes the metrics as Prometheus text exposition format when "path" ends in .prom, otherwise as JSON'''
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            if path.endswith('.prom'):
+                metrics_file.write(self.prometheus())
+            else:
+                json.dump(self.as_dict(), metrics_file, indent=2)
+
+    def prometheus(self) -> str:
+        lines = [
+            '# HELP bitbucket_mirror_requests_total Api requests sent, by response status.',
+            '# TYPE bitbucket_mirror_requests_total counter',
+        ]
+        rows = self.as_dict()
+        label = lambda row: f'host="{row["host"]}",method="{row["method"]}",endpoint="{row["endpoint"]}"'
+        for row in rows:
+            for status, count in sorted(row['statuses'].items()):
+                lines.append(f'bitbucket_mirror_requests_total{{{label(row)},status="{status}"}} {count}')
+        for name, key, description in [('retries_total', 'retries', 'Api requests retried after a 429/5xx response.'),
+                                       ('rate_limit_sleep_seconds_total', 'rate_limit_sleep_seconds', 'Seconds spent paused for rate limits.'),
+                                       ('sent_bytes_total', 'bytes_sent', 'Request body bytes sent.'),
+                                       ('received_bytes_total', 'bytes_received', 'Response body bytes received.')]:
+            lines += [f'# HELP bitbucket_mirror_{name} {description}', f'# TYPE bitbucket_mirror_{name} counter']
+            lines += [f'bitbucket_mirror_{name}{{{label(row)}}} {row[key]}' for row in rows]
+        lines += ['# HELP bitbucket_mirror_request_latency_seconds Api request latency.', '# TYPE bitbucket_mirror_request_latency_seconds summary']
+        for row in rows:
+            latency = row['latency_seconds']
+            for quantile, key in [('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')]:
+                lines.append(f'bitbucket_mirror_request_latency_seconds{{{label(row)},quantile="{quantile}"}} {latency[key]}')
+            lines.append(f'bitbucket_mirror_request_latency_seconds_sum{{{label(row)}}} {latency["total"]}')
+            lines.append(f'bitbucket_mirror_request_latency_seconds_count{{{label(row)}}} {row["requests"]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = RequestMetrics()
@@ -1,169 +1,455 @@
-from resources.instance_actions import Group, Project, Repository, ServerActions as SA, CloudActions as CA
+from resources.instance_actions import GlobalGroup, Project, Repository, User, intern, ServerActions as SA, CloudActions as CA
 from resources.instance_init import ServerInstance, CloudInstance
-from typing import Tuple
-from .instance_actions import Project
+from resources.scan_cache import ScanCache
+from resources.checkpoint import Checkpoint
+from resources.cloud_state import CloudState
+from resources.permissions import PermissionFlattener
+from resources.member_index import WorkspaceMemberIndex
+from resources.group_registry import GroupRegistry
+from resources.server_export import ServerExport
+from resources.scope import Scope
+from resources.progress import progress
+from resources.retry_queue import RetryQueue, retry_queue
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Generator, Iterable, Iterator, Tuple
 
 class ServerDetails:
     @staticmethod
-    def scan_server_structure(server: ServerInstance) -> Tuple[list, dict, list]:
-        groups_to_migrate = []
-        global_groups = []
-        for group in SA.get_group_global_permissions(server):
-            global_groups.append(group)
-            groups_to_migrate.append(group.name)
+    def scan_server_structure(server: ServerInstance, cache: ScanCache=None) -> Tuple[GroupRegistry, list, list]:
+        global_groups = list(SA.get_group_global_permissions(server))
+        groups_to_migrate = GroupRegistry(global_groups)
 
-        used_groups, server_structure = ServerDetails.get_project_and_repo_structure(server)
-        for group in used_groups:
-            if group.name not in groups_to_migrate:
-                groups_to_migrate.append(group.name)
+        if cache is not None and cache.load():
+            server_structure = ServerDetails.refresh_project_and_repo_structure(server, cache)
+        else:
+            server_structure = ServerDetails.get_project_and_repo_structure(server)
+        for project in server_structure:
+            groups_to_migrate.register(project)
+
+        if cache is not None:
+            cache.save(groups_to_migrate, global_groups, server_structure)
+        return groups_to_migrate, global_groups, server_structure
 
+    @staticmethod
+    def ingest_server_structure(path: str, scope: Scope=None) -> Tuple[GroupRegistry, list, list]:
+        '''Builds the same structures as scan_server_structure from a local export, see resources/server_export.py'''
+        global_groups, server_structure = ServerExport.load(path, scope)
+        if scope is not None and scope.active:
+            global_groups = [group for group in global_groups if scope.includes_group(group.name)]
+            server_structure = scope.apply(server_structure)
+        groups_to_migrate = GroupRegistry(global_groups)
+        for project in server_structure:
+            groups_to_migrate.register(project)
         return groups_to_migrate, global_groups, server_structure
 
     @staticmethod
-    def get_project_and_repo_structure(server: ServerInstance) -> Tuple[list[Group], list[Project]]:
-        used_groups = []
-        project_repo_structure = []
-        ''' TODO
-        Potentially speed up the script by multi-threading out each group and repo respectively
-        as there's a lot of wasted time waiting for network responses (I/O).
+    def get_project_and_repo_structure(server: ServerInstance, max_workers: int=None, projects: list[Project]=None) -> list[Project]:
+        '''
+        Scans every project up front, see iter_project_and_repo_structure.
+        Only "projects" are scanned when given, otherwise every project in the instance.
+        '''
+        return list(ServerDetails.iter_project_and_repo_structure(server, max_workers, projects if projects is not None else list(SA.get_projects(server, default_permissions=False))))
+
+    @staticmethod
+    def iter_project_and_repo_structure(server: ServerInstance, max_workers: int=None, projects: Iterable[Project]=None, window: int=None) -> Generator[Project, None, None]:
+        '''
+        Yields each project, with its groups and repos (and their groups) filled in, in listing order.
+        Requests are fanned out over a bounded pool of workers as the scan is almost entirely network wait.
+        A project's default permission (unless it is already known), groups and repos are requested as soon as it is
+        listed, then each repo's groups as soon as its project's repo listing comes back.
+        Projects left without any repo in the server's scope are dropped, see resources/scope.py.
+        With a "window" at most that many projects are read ahead of the one being yielded, so projects can be
+        consumed while the rest of the instance is still being scanned without holding all of it in memory.
+        Without one every project is requested up front.
+        '''
+        with ThreadPoolExecutor(max_workers=max_workers or server.max_workers) as executor:
+            if projects is None:
+                projects = SA.get_projects(server, default_permissions=False)
+            sized = hasattr(projects, '__len__')
+            if sized:
+                progress.add_total('scan', len(projects))
+            listing = deque()
+            scanning = deque()
+
+            def scan_repos() -> None:
+                project, default, groups, repos = listing.popleft()
+                scanning.append((project, default, groups, [(repo, executor.submit(ServerDetails._list, SA.get_repo_groups, server, project, repo))
+                                                            for repo in repos.result()]))
+
+            def assemble() -> Project:
+                project, default, groups, repos = scanning.popleft()
+                if default is not None:
+                    project.default_permission = intern(default.result())
+                project.groups.extend(groups.result())
+                for repo, groups in repos:
+                    repo.groups.extend(groups.result())
+                    project.repositories.append(repo)
+                progress.advance('scan')
+                return project
+
+            for project in projects:
+                if not sized:
+                    progress.add_total('scan', 1)
+                listing.append((project, ServerDetails._submit_default_permission(executor, server, project),
+                                executor.submit(ServerDetails._list, SA.get_project_groups, server, project),
+                                executor.submit(ServerDetails._list, SA.get_repos, server, project)))
+                if window is not None and len(listing) > window:
+                    scan_repos()
+                if window is not None and len(scanning) > window:
+                    scanned = assemble()
+                    if server.scope.keeps(scanned):
+                        yield scanned
+            while listing:
+                scan_repos()
+            while scanning:
+                scanned = assemble()
+                if server.scope.keeps(scanned):
+                    yield scanned
+            progress.finish('scan')
+
+    @staticmethod
+    def refresh_project_and_repo_structure(server: ServerInstance, cache: ScanCache) -> list[Project]:
+        '''
+        Rebuilds the server structure from a loaded scan cache, only re-scanning the projects the cache considers stale.
+        When the cache is set to detect changes, the project listing and each reused project's repo listing are re-read
+        so that new projects/repos are scanned, removed ones are dropped and public/default permissions are refreshed.
         '''
-        for project in SA.get_projects(server):
-            for group in SA.get_project_groups(server, project):
-                project.groups.append(group)
-                if group.name not in used_groups:
-                    used_groups.append(group)
-            for repo in SA.get_repos(server, project):
-                for group in SA.get_repo_groups(server, project, repo):
-                    repo.groups.append(group)
-                    if group.name not in used_groups:
-                        used_groups.append(group)
-                project.repositories.append(repo)
-            project_repo_structure.append(project)
-
-        return used_groups, project_repo_structure
+        if cache.detect_changes:
+            projects = list(SA.get_projects(server, default_permissions=False))
+        else:
+            projects = [project for project in cache.projects.values() if server.scope.includes_project(project.key)]
+        stale_projects = [project for project in projects if cache.is_stale(project.key)]
+        if not cache.detect_changes:
+            # Cached projects carry their old groups/repos, start over from their listing details
+            stale_projects = [Project(project.key, project.name, project.public, None) for project in stale_projects]
+        print(f'INFO: Re-scanning {len(stale_projects)} of {len(projects)} projects, the rest are loaded from the scan cache "{cache.path}"')
+
+        rescanned = ServerDetails.get_project_and_repo_structure(server, projects=stale_projects)
+        rescanned = {project.key: project for project in rescanned}
+        for project_key in rescanned:
+            cache.mark_scanned(project_key)
+        if cache.detect_changes:
+            # projects new since the cache was saved, and left without any repo in scope, are in neither
+            ServerDetails._reconcile_repos(server, [cache.projects[project.key] for project in projects if project.key not in rescanned and project.key in cache.projects],
+                                           {project.key: project for project in projects})
+
+        # cached projects were scanned without the current scope's repo and group filters
+        # (projects left without any repo in scope were dropped from the re-scan, and new ones aren't in the cache)
+        server_structure = [rescanned.get(project.key) or cache.projects.get(project.key) for project in projects]
+        return server.scope.apply([project for project in server_structure if project is not None])
+
+    @staticmethod
+    def _reconcile_repos(server: ServerInstance, cached_projects: list[Project], listed_projects: dict[str, Project]) -> None:
+        # Brings the repositories of reused cached projects in line with the server's current listings
+        with ThreadPoolExecutor(max_workers=server.max_workers) as executor:
+            project_repos = [(project, ServerDetails._submit_default_permission(executor, server, listed_projects[project.key]),
+                              executor.submit(ServerDetails._list, SA.get_repos, server, project)) for project in cached_projects]
+            for project, default, repos in project_repos:
+                listed = listed_projects[project.key]
+                project.public, project.default_permission = listed.public, intern(default.result()) if default is not None else listed.default_permission
+                known_repos = {repo.slug: repo for repo in project.repositories}
+                repositories = []
+                for repo in repos.result():
+                    if repo.slug in known_repos:
+                        known_repos[repo.slug].default_permission = repo.default_permission
+                        repositories.append((known_repos[repo.slug], None))
+                    else:
+                        repositories.append((repo, executor.submit(ServerDetails._list, SA.get_repo_groups, server, project, repo)))
+                project.repositories = []
+                for repo, groups in repositories:
+                    if groups is not None:
+                        repo.groups = groups.result()
+                    project.repositories.append(repo)
+
+    @staticmethod
+    def _submit_default_permission(executor: ThreadPoolExecutor, server: ServerInstance, project: Project) -> Future:
+        # Requests the default permission of a project listed without it, returns None when it is already known
+        if project.default_permission is not None:
+            return None
+        return executor.submit(SA.get_project_default_permission, server, {'key': project.key, 'public': project.public})
+
+    @staticmethod
+    def _list(generator: Callable[..., Iterator], *args) -> list:
+        # Drains a paged generator within a worker thread so only the finished list crosses back to the caller
+        return list(generator(*args))
 
 
 class ActionOnItems:
     @staticmethod
-    def mirror_groups(server: ServerInstance, cloud: CloudInstance, groups_to_migrate: list[str], global_groups: list[Group]) -> dict:
+    def mirror_groups(server: ServerInstance, cloud: CloudInstance, groups_to_migrate: list[str], global_groups: list[GlobalGroup], checkpoint: Checkpoint=None, cloud_state: CloudState=None) -> dict:
+        '''
+        Groups are mirrored in parallel, each on its own worker so that a group is always created before its
+        members are added. Member additions are handed to a second pool to keep independent writes flowing.
+        Summaries are printed in the original group order once each group's writes have finished.
+        Writes already recorded in "checkpoint" by an earlier run, or already present in the workspace according to
+        "cloud_state", are skipped and counted as successful.
+        Every group's members are read up front so the workspace membership of all of them can be looked up at once.
+        Memberships of users that aren't in the workspace yet are then failed locally, rather than by a doomed request,
+        and those users are reported together at the end.
+        returns the groups needing workspace privileges set by hand, and the counts of groups and memberships mirrored
+        '''
         group_counter = 0
         group_memberships = 0
         group_workspace_privileges = {'create_repositories': [], 'admin_workspace': []}
 
-        for group_name in groups_to_migrate:
-            if not CA.create_group(cloud, group_name):
-                print(f'WARN: Failed to mirror group "{group_name}" to your cloud instance for unknown reason.')
+        registry = GroupRegistry(global_groups)
+        member_index = WorkspaceMemberIndex(cloud)
+        if cloud_state is not None:
+            cloud_state.use_member_index(member_index)
+        with ThreadPoolExecutor(max_workers=server.max_workers) as executor:
+            list_members = lambda group_name: [member_index.intern(member) for member in SA.get_group_members(server, group_name)]
+            group_members = list(executor.map(list_members, groups_to_migrate))
+        member_index.load(member.emailAddress for members in group_members for member in members)
+        skipped_memberships = {}
+        progress.add_total('groups', len(groups_to_migrate))
+        progress.add_total('memberships', sum(len(members) for members in group_members))
+
+        with ThreadPoolExecutor(max_workers=cloud.max_workers) as group_executor, \
+             ThreadPoolExecutor(max_workers=cloud.max_workers) as member_executor:
+            migrations = [group_executor.submit(ActionOnItems._mirror_group, cloud, group_name, members, registry, member_executor, member_index, checkpoint, cloud_state)
+                          for group_name, members in zip(groups_to_migrate, group_members)]
+
+            for group_name, migration in zip(groups_to_migrate, migrations):
+                migrated_users = ActionOnItems.report_group_migration(group_name, migration.result(), group_workspace_privileges, skipped_memberships)
+                if migrated_users is not None:
+                    group_counter += 1
+                    group_memberships += migrated_users
+        progress.finish('groups')
+        progress.finish('memberships')
+
+        ActionOnItems.report_group_totals(group_counter, group_memberships, skipped_memberships)
+        return {'group_workspace_privileges': group_workspace_privileges, 'groups': group_counter,
+                'group_memberships': group_memberships, 'skipped_memberships': skipped_memberships}
+
+    @staticmethod
+    def report_group_migration(group_name: str, group_migration: dict, group_workspace_privileges: dict, skipped_memberships: dict) -> int:
+        # Prints the outcome of one _mirror_group, returns the number of memberships added or None when the group wasn't mirrored
+        progress.advance('groups')
+        if group_migration is None:
+            progress.fail('groups', 'write_failed', operation='create_group', group=group_name)
+            print(f'WARN: Failed to mirror group "{group_name}" to your cloud instance for unknown reason.')
+            return None
+        if not group_migration['global_perms_applied']:
+            progress.fail('groups', 'write_failed', operation='set_group_global_access', group=group_name)
+            print(f'WARN: Failed to apply global permissions to {group_name} within your cloud instance.')
+        permission = group_migration['permission']
+        if permission == "create_repositories":
+            group_workspace_privileges.get('create_repositories').append(group_name)
+        elif permission == "admin_workspace":
+            group_workspace_privileges.get('admin_workspace').append(group_name)
+        for user_email in group_migration['not_in_workspace']:
+            skipped_memberships[user_email] = skipped_memberships.get(user_email, 0) + 1
+
+        if group_migration['members'] == group_migration['migrated']:
+            print(f'INFO: Successfully migrated all {group_migration["members"]} users in group: {group_name}')
+        else:
+            logged = f' The users that could not be added were logged to "{progress.failure_log_path}".' if progress.failure_log_path else ''
+            print(f"WARN: Successfully migrated {group_migration['migrated']} of {group_migration['members']} members of {group_name}"
+                  f" (Likely due to the user not being present in the workspace).{logged}")
+        return group_migration['migrated']
+
+    @staticmethod
+    def report_group_totals(group_counter: int, group_memberships: int, skipped_memberships: dict) -> None:
+        print(f'INFO: Mirrored {group_counter} groups with {group_memberships} group membership assignments')
+        ActionOnItems.report_skipped_memberships(skipped_memberships)
+
+    @staticmethod
+    def report_skipped_memberships(skipped_memberships: dict) -> None:
+        # skipped_memberships counts the memberships of each user that isn't in the workspace yet
+        if skipped_memberships:
+            print(f'WARN: {len(skipped_memberships)} users are not members of your cloud workspace yet, so their {sum(skipped_memberships.values())} group memberships were not attempted.',
+                  'Once these users have been migrated re-run this script to add them to their groups:')
+            print('-'*10)
+            print(', '.join(sorted(skipped_memberships)))
+            print('-'*10)
+
+    @staticmethod
+    def _mirror_group(cloud: CloudInstance, group_name: str, members: list[User], registry: GroupRegistry, member_executor: ThreadPoolExecutor,
+                      member_index: WorkspaceMemberIndex, checkpoint: Checkpoint=None, cloud_state: CloudState=None) -> dict:
+        # Returns None when the group itself could not be created, otherwise the outcome of its permission and member writes
+        # Memberships that fail are logged as they happen rather than kept, see resources/progress.py, and queued for --retry
+        if not ActionOnItems._write(checkpoint, cloud_state, ('create_group', group_name), CA.create_group, cloud, group_name):
+            progress.advance('memberships', len(members))
+            for member in members:
+                retry_queue.add('group_not_created', 'add_member_to_group', group=group_name, email=member.emailAddress)
+            return None
+        success, permission = ActionOnItems.add_group_global_perms(cloud, group_name, registry, checkpoint, cloud_state)
+        group_migration = {'global_perms_applied': success, 'permission': permission, 'members': len(members), 'migrated': 0, 'not_in_workspace': []}
+        additions = []
+        for member in members:
+            if member_index.is_member(member.emailAddress) is False:
+                group_migration['not_in_workspace'].append(member.emailAddress)
+                progress.advance('memberships')
+                progress.fail('memberships', 'user_not_in_workspace', operation='add_member_to_group', group=group_name, email=member.emailAddress)
+                retry_queue.add('user_not_in_workspace', 'add_member_to_group', group=group_name, email=member.emailAddress)
                 continue
-            success, permission = ActionOnItems.add_group_global_perms(cloud, group_name, global_groups)
-            if not success:
-                print(f'WARN: Failed to apply global permissions to {group_name} within your cloud instance.')
-            if permission == "create_repositories":
-                group_workspace_privileges.get('create_repositories').append(group_name)
-            elif permission == "admin_workspace":
-                group_workspace_privileges.get('admin_workspace').append(group_name)
-            group_migration = {'total_users': [], 'migrated_users': []}
-            group_counter += 1
-            for member in SA.get_group_members(server, group_name):
-                group_migration['total_users'].append(member.emailAddress)
-                if CA.add_member_to_group(cloud, group_name, member):
-                    group_migration['migrated_users'].append(member.emailAddress)
-                    group_memberships += 1
-
-            if len(group_migration['total_users']) == len(group_migration['migrated_users']):
-                print(f'INFO: Successfully migrated all {len(group_migration["total_users"])} users in group: {group_name}')
+            additions.append((member, member_executor.submit(ActionOnItems._write, checkpoint, cloud_state, ('add_member_to_group', group_name, member.emailAddress),
+                                                             CA.add_member_to_group, cloud, group_name, member)))
+        for member, addition in additions:
+            progress.advance('memberships')
+            if addition.result():
+                group_migration['migrated'] += 1
             else:
-                print(f"WARN: Successfully migrated {len(group_migration['migrated_users'])} of {len(group_migration['total_users'])} members of {group_name}.",
-                      "Failed to mirror the following users to the group's membership (Likely due to the user not being present in the workspace):")
-                print('-'*10)
-                print(', '.join([user_email for user_email in group_migration['total_users'] if user_email not in group_migration['migrated_users']]))
-                print('-'*10)
+                progress.fail('memberships', 'write_failed', operation='add_member_to_group', group=group_name, email=member.emailAddress)
+                retry_queue.add('write_failed', 'add_member_to_group', group=group_name, email=member.emailAddress)
+        return group_migration
 
-        print(f'INFO: Mirrored {group_counter} groups with {group_memberships} group membership assignments')
-        return group_workspace_privileges
+    @staticmethod
+    def add_group_global_perms(cloud: CloudInstance, group_name: str, registry: GroupRegistry, checkpoint: Checkpoint=None, cloud_state: CloudState=None) -> tuple[bool, str]:
+        known, access, privilege = ActionOnItems.global_group_access(group_name, registry)
+        if not known:
+            return False, None
+        if access is None:
+            return True, privilege
+        return ActionOnItems._write(checkpoint, cloud_state, ('set_group_global_access', group_name, access), CA.set_group_global_access, cloud, group_name, access), privilege
 
     @staticmethod
-    def add_group_global_perms(cloud: CloudInstance, group_name: str, global_groups: list[Group]) -> tuple[bool, str]:
-        try:
-            group = [group for group in global_groups if group.name == group_name][0]
-        except IndexError:
+    def global_group_access(group_name: str, registry: GroupRegistry) -> tuple[bool, str, str]:
+        '''
+        Decides what a group's Server global permission translates to within the workspace, without writing anything.
+        returns whether the global permission is understood, the default access to set over every repo in the workspace
+        (or None) and the workspace privilege that must be granted by hand (or None)
+        '''
+        if not registry.is_global(group_name):
             # not every group must be a global group in server, if this is the case then simply skip
-            return True, None
+            return True, None, None
 
-        if group.permission == "LICENSED_USER":
+        permission = registry.global_permission(group_name)
+        if permission == "LICENSED_USER":
             # do nothing as this is already implied by existing in the workspace
-            return True, None
-        elif group.permission == "PROJECT_CREATE":
+            return True, None, None
+        elif permission == "PROJECT_CREATE":
             # No default read/write/admin on any existing content
-            return True, "create_repositories"
-        elif group.permission == "ADMIN":
-            return CA.set_group_global_access(cloud, group.name, "admin"), "create_repositories"
-        elif group.permission == "SYS_ADMIN":
-            return CA.set_group_global_access(cloud, group.name, "admin"), "admin_workspace"
+            return True, None, "create_repositories"
+        elif permission == "ADMIN":
+            return True, "admin", "create_repositories"
+        elif permission == "SYS_ADMIN":
+            return True, "admin", "admin_workspace"
 
-        return False, None
+        return False, None, None
 
     @staticmethod
-    def mirror_repo_groups(server: ServerInstance, cloud: CloudInstance, groups_to_migrate: list[str], server_structure: list[Project]) -> None:
+    def mirror_repo_groups(server: ServerInstance, cloud: CloudInstance, groups_to_migrate: list[str], server_structure: list[Project], checkpoint: Checkpoint=None, cloud_state: CloudState=None) -> dict:
         successful_repo_counter = 0
         total_repo_counter = 0
-        for project in server_structure:
+        # One listing of the workspace replaces a verify_repo_exists lookup per server repo
+        cloud_repos = CA.get_repo_slugs(cloud)
+        flattener = PermissionFlattener(groups_to_migrate)
+        progress.add_total('repos', sum(len(project.repositories) for project in server_structure))
+        with ThreadPoolExecutor(max_workers=cloud.max_workers) as repo_executor, \
+             ThreadPoolExecutor(max_workers=cloud.max_workers) as write_executor:
+            mirrors = [(repo, repo_executor.submit(ActionOnItems._mirror_repo, cloud, cloud_repos, project, repo, flattener, write_executor, checkpoint, cloud_state))
+                       for project in server_structure for repo in project.repositories]
+
             repo: Repository
-            for repo in project.repositories:
-                if not CA.verify_repo_exists(cloud, repo.slug):
-                    print(f'INFO: Skipping repo "{repo.name}" as it is not present within your cloud workspace. This may not have been migrated yet.')
+            for repo, mirror in mirrors:
+                atleast_one_group_migrated = ActionOnItems.report_repo_migration(repo, *mirror.result())
+                if atleast_one_group_migrated is None:
                     continue
-                print(f'INFO: Mirroring group permissions for repo: "{repo.name}"')
-                atleast_one_group_migrated = False
-                for group_name, flattened_permission in ActionOnItems.max_permission(project.default_permission, project.groups, repo.default_permission, repo.groups, groups_to_migrate):
-                    if flattened_permission == "none":
-                        continue
-                    if CA.add_group_to_repo(cloud, repo.slug, group_name, flattened_permission):
-                        atleast_one_group_migrated = True
-                    else:
-                        print(f'WARN: Failed to add group "{group_name}" with permission "{flattened_permission}" to "{repo.name}".')
                 if atleast_one_group_migrated:
                     successful_repo_counter += 1
                 total_repo_counter += 1
+        progress.finish('repos')
         print(f'INFO: Successfully mirrored the groups/permissions for {successful_repo_counter} of {total_repo_counter} repositories.')
+        return {'successful_repos': successful_repo_counter, 'total_repos': total_repo_counter}
+
+    @staticmethod
+    def report_repo_migration(repo: Repository, repo_exists: bool, group_results: list) -> bool:
+        # Prints the outcome of one _mirror_repo, returns whether any group was added or None when the repo isn't in the workspace
+        progress.advance('repos')
+        if not repo_exists:
+            progress.fail('repos', 'repo_not_migrated', repo=repo.slug)
+            print(f'INFO: Skipping repo "{repo.name}" as it is not present within your cloud workspace. This may not have been migrated yet.')
+            return None
+        print(f'INFO: Mirroring group permissions for repo: "{repo.name}"')
+        atleast_one_group_migrated = False
+        for group_name, flattened_permission, success in group_results:
+            if success:
+                atleast_one_group_migrated = True
+            else:
+                progress.fail('repos', 'write_failed', operation='add_group_to_repo', group=group_name, repo=repo.slug, permission=flattened_permission)
+                retry_queue.add('write_failed', 'add_group_to_repo', group=group_name, repo=repo.slug, permission=flattened_permission)
+                print(f'WARN: Failed to add group "{group_name}" with permission "{flattened_permission}" to "{repo.name}".')
+        return atleast_one_group_migrated
+
+    @staticmethod
+    def _mirror_repo(cloud: CloudInstance, cloud_repos: set[str], project: Project, repo: Repository, flattener: PermissionFlattener, write_executor: ThreadPoolExecutor, checkpoint: Checkpoint=None, cloud_state: CloudState=None) -> tuple[bool, list]:
+        # Returns whether the repo exists in the workspace and the (group, permission, success) outcome of each privilege write
+        if repo.slug not in cloud_repos:
+            # its privileges are queued so --retry can write them once the repo has been migrated
+            for group_name, flattened_permission in flattener.flatten(project, repo):
+                retry_queue.add('repo_not_migrated', 'add_group_to_repo', group=group_name, repo=repo.slug, permission=flattened_permission)
+            return False, []
+        writes = []
+        for group_name, flattened_permission in flattener.flatten(project, repo):
+            key = ('add_group_to_repo', group_name, repo.slug, flattened_permission)
+            writes.append((group_name, flattened_permission, write_executor.submit(ActionOnItems._write, checkpoint, cloud_state, key, CA.add_group_to_repo, cloud, repo.slug, group_name, flattened_permission)))
+        return True, [(group_name, flattened_permission, write.result()) for group_name, flattened_permission, write in writes]
 
     @staticmethod
-    def max_permission(project_default_permission: str, project_groups: list[Group], repo_default_permission: str, repo_groups: list[Group], groups_to_migrate: list[str]) -> str:
+    def retry_queued(cloud: CloudInstance, queue: RetryQueue, checkpoint: Checkpoint=None, cloud_state: CloudState=None) -> dict:
         '''
-        project_default can be "None", "Read", or "Write"
-        project_permission can be "None", "Read", "Write" or "Admin"
-        repo_permission can be "None", "Read", "Write", or "Admin"
-        repo_default can be "None" or "Read" (public checkbox)
-        
-        Determine/return the flattened/effective permission
+        Re-attempts the memberships and repository group privileges in "queue", then rewrites it with the ones still outstanding.
+        Groups that failed to be created are created first. Items whose user still isn't in the workspace, or whose
+        repo still hasn't been migrated, are kept without a request being made for them. The rest are written in parallel.
+        returns the number of items retried, mirrored and still queued
         '''
-        for group_name in groups_to_migrate:
-            group_project_perm = ActionOnItems.lookup_group_perm(group_name, project_groups)
-            group_repo_perm = ActionOnItems.lookup_group_perm(group_name, repo_groups)
-            perms = [project_default_permission, group_project_perm, repo_default_permission, group_repo_perm]
-            if "Admin" in perms:
-                yield group_name, "admin"
-            elif "Write" in perms:
-                yield group_name, "write"
-            elif "Read" in perms:
-                yield group_name, "read"
-            else:
-                yield group_name, "none"
-
-    @staticmethod
-    def lookup_group_perm(group_name: str, groups: list[Group]) -> str:
-        permission = "None"
-        for group in groups:
-            if group.name == group_name:
-                permission = group.permission
-                break
-
-        if permission in ["PROJECT_ADMIN", "REPO_ADMIN"]:
-            permission = "Admin"
-        elif permission in ["PROJECT_WRITE", "REPO_WRITE"]:
-            permission = "Write"
-        elif permission in ["PROJECT_READ", "REPO_READ"]:
-            permission = "Read"
-        return permission
+        items = queue.load()
+        print(f'INFO: Loaded {len(items)} queued items from "{queue.path}": {RetryQueue.summary(items)}')
+        remaining = []
+        with ThreadPoolExecutor(max_workers=cloud.max_workers) as executor:
+            missing_groups = sorted({item['group'] for item in items if item['reason'] == 'group_not_created'})
+            create = lambda group_name: ActionOnItems._write(checkpoint, cloud_state, ('create_group', group_name), CA.create_group, cloud, group_name)
+            created_groups = {group_name for group_name, created in zip(missing_groups, executor.map(create, missing_groups)) if created}
+
+            member_index = WorkspaceMemberIndex(cloud)
+            if cloud_state is not None:
+                cloud_state.use_member_index(member_index)
+            member_index.load(item['email'] for item in items if item['op'] == 'add_member_to_group')
+            cloud_repos = CA.get_repo_slugs(cloud) if any(item['op'] == 'add_group_to_repo' for item in items) else set()
+            attempts = []
+            for item in items:
+                if item['reason'] == 'group_not_created' and item['group'] not in created_groups:
+                    remaining.append(item)
+                elif item['op'] == 'add_member_to_group' and member_index.is_member(item['email']) is False:
+                    remaining.append({**item, 'reason': 'user_not_in_workspace'})
+                elif item['op'] == 'add_group_to_repo' and item['repo'] not in cloud_repos:
+                    remaining.append({**item, 'reason': 'repo_not_migrated'})
+                else:
+                    attempts.append(item)
+
+            progress.add_total('memberships', sum(item['op'] == 'add_member_to_group' for item in attempts))
+            progress.add_total('privileges', sum(item['op'] == 'add_group_to_repo' for item in attempts))
+            def attempt(item: dict) -> bool:
+                if item['op'] == 'add_member_to_group':
+                    member = User(None, item['email'], None, None)
+                    return ActionOnItems._write(checkpoint, cloud_state, ('add_member_to_group', item['group'], item['email']), CA.add_member_to_group, cloud, item['group'], member)
+                return ActionOnItems._write(checkpoint, cloud_state, ('add_group_to_repo', item['group'], item['repo'], item['permission']),
+                                            CA.add_group_to_repo, cloud, item['repo'], item['group'], item['permission'])
+            for item, success in zip(attempts, executor.map(attempt, attempts)):
+                phase = 'memberships' if item['op'] == 'add_member_to_group' else 'privileges'
+                progress.advance(phase)
+                if not success:
+                    progress.fail(phase, 'write_failed', operation=item['op'], **{key: value for key, value in item.items() if key not in ('reason', 'op')})
+                    remaining.append({**item, 'reason': 'write_failed'})
+        progress.finish('memberships')
+        progress.finish('privileges')
+
+        queue.rewrite(remaining)
+        mirrored = len(items) - len(remaining)
+        print(f'INFO: Retried {len(attempts)} of {len(items)} queued items and mirrored {mirrored} of them. '
+              f'Still queued in "{queue.path}": {RetryQueue.summary(remaining)}')
+        return {'retried': len(attempts), 'mirrored': mirrored, 'queued': len(remaining)}
+
+    @staticmethod
+    def _write(checkpoint: Checkpoint, cloud_state: CloudState, key: tuple, write: Callable[..., bool], *args) -> bool:
+        # Skips cloud writes that sync mode found already in place, and routes the rest through the checkpoint journal when one is in use
+        if cloud_state is not None and cloud_state.done(*key):
+            return True
+        if checkpoint is None:
+            return write(*args)
+        return checkpoint.run(key, write, *args)
 
     @staticmethod
     def print_group_privilege_details(group_workspace_privileges: dict, workspace_name: str) -> None:
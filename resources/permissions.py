@@ -0,0 +1,83 @@
+from resources.instance_actions import Group, Project, Repository
+from enum import IntEnum
+from typing import Generator
+
+
+class Permission(IntEnum):
+    '''Server permission levels ordered so that the effective permission of several grants is simply their max()'''
+    NONE = 0
+    READ = 1
+    WRITE = 2
+    ADMIN = 3
+
+    @classmethod
+    def parse(cls, permission: str) -> 'Permission':
+        # Accepts flattened ("Read"), project ("PROJECT_READ") and repo ("REPO_READ") level names, anything else grants nothing
+        return _SERVER_PERMISSIONS.get(permission, cls.NONE)
+
+    @property
+    def cloud_name(self) -> str:
+        return self.name.lower()
+
+
+_SERVER_PERMISSIONS = {
+    "Read": Permission.READ, "PROJECT_READ": Permission.READ, "REPO_READ": Permission.READ,
+    "Write": Permission.WRITE, "PROJECT_WRITE": Permission.WRITE, "REPO_WRITE": Permission.WRITE,
+    "Admin": Permission.ADMIN, "PROJECT_ADMIN": Permission.ADMIN, "REPO_ADMIN": Permission.ADMIN,
+}
+
+
+class PermissionFlattener:
+    '''
+    Flattens project and repository permissions into the effective permission of each group on a repository.
+
+    Each project's explicit group grants are parsed once into a {group: Permission} map and merged with a repo's
+    own grants. When neither the project nor the repo grant a default/public permission only the groups with an
+    explicit grant can end up with access, so just those are visited instead of every group in groups_to_migrate.
+    Groups are yielded in groups_to_migrate order, and groups with no effective permission are never yielded.
+    '''
+    def __init__(self, groups_to_migrate: list[str]):
+        self.groups_to_migrate = list(groups_to_migrate)
+        self.order = {group_name: position for position, group_name in enumerate(self.groups_to_migrate)}
+        self.project_grants = {}
+
+    def add(self, group_name: str) -> None:
+        # Groups discovered after flattening began are ordered after the ones already known
+        if group_name not in self.order:
+            self.order[group_name] = len(self.groups_to_migrate)
+            self.groups_to_migrate.append(group_name)
+
+    def forget(self, project: Project) -> None:
+        # Drops a project's cached grants once none of its repos will be flattened again
+        self.project_grants.pop(project.key, None)
+
+    @staticmethod
+    def default(project: Project, repo: Repository) -> Permission:
+        '''the default/public permission every group has on "repo"'''
+        return max(Permission.parse(project.default_permission), Permission.parse(repo.default_permission))
+
+    def grants(self, groups: list[Group]) -> dict[str, Permission]:
+        grants = {}
+        for group in groups:
+            # the first grant listed for a group wins, as it would with a linear lookup
+            if group.name in self.order and group.name not in grants:
+                grants[group.name] = Permission.parse(group.permission)
+        return grants
+
+    def flatten(self, project: Project, repo: Repository) -> Generator[tuple[str, str], None, None]:
+        project_grants = self.project_grants.get(project.key)
+        if project_grants is None:
+            project_grants = self.project_grants[project.key] = self.grants(project.groups)
+        effective = dict(project_grants)
+        for group_name, permission in self.grants(repo.groups).items():
+            effective[group_name] = max(effective.get(group_name, Permission.NONE), permission)
+
+        default = PermissionFlattener.default(project, repo)
+        if default:
+            for group_name in self.groups_to_migrate:
+                yield group_name, max(default, effective.get(group_name, Permission.NONE)).cloud_name
+            return
+
+        for group_name in sorted(effective, key=self.order.get):
+            if effective[group_name]:
+                yield group_name, effective[group_name].cloud_name
@@ -0,0 +1,179 @@
+from resources.instance_actions import GlobalGroup, Project, User, ServerActions as SA, CloudActions as CA
+from resources.instance_init import ServerInstance, CloudInstance
+from resources.mirror_operations import ActionOnItems
+from resources.permissions import PermissionFlattener
+from resources.checkpoint import Checkpoint
+from resources.cloud_state import CloudState
+from resources.group_registry import GroupRegistry
+from resources.member_index import WorkspaceMemberIndex
+from resources.progress import progress
+from resources.retry_queue import retry_queue
+from collections import Counter, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Generator, Iterable
+import json
+
+
+def bounded_map(executor: Executor, function: Callable, items: Iterable, window: int) -> Generator[tuple, None, None]:
+    '''
+    Runs "function" over "items" on "executor", yielding (item, result) in order.
+    At most "window" items are in flight at once so arbitrarily long inputs can be streamed through the pool.
+    '''
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(function, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+class MigrationPlan:
+    '''
+    The complete set of cloud writes derived from a server scan, stored as JSON lines with one operation per line:
+        {"op": "create_group", "group": ...}
+        {"op": "set_group_global_access", "group": ..., "permission": ...}
+        {"op": "workspace_privilege", "group": ..., "privilege": "create_repositories"|"admin_workspace"}
+        {"op": "add_member_to_group", "group": ..., "email": ..., "name": ..., "displayName": ..., "slug": ...}
+        {"op": "add_group_to_repo", "project": ..., "repo": ..., "repo_name": ..., "group": ..., "permission": ...}
+
+    "workspace_privilege" lines can't be applied through the api and are only reported, as by print_group_privilege_details.
+    A plan can be reviewed, split up or edited before it is applied.
+    '''
+    @staticmethod
+    def write(path: str, server: ServerInstance, groups_to_migrate: list[str], global_groups: list[GlobalGroup], server_structure: list[Project]) -> Counter:
+        counts = Counter()
+        registry = GroupRegistry(global_groups)
+        with open(path, 'w', encoding='utf-8') as plan_file, ThreadPoolExecutor(max_workers=server.max_workers) as executor:
+            def emit(**operation) -> None:
+                plan_file.write(json.dumps(operation) + '\n')
+                counts[operation['op']] += 1
+
+            list_members = lambda group_name: list(SA.get_group_members(server, group_name))
+            for group_name, members in bounded_map(executor, list_members, groups_to_migrate, server.max_workers * 2):
+                emit(op='create_group', group=group_name)
+                known, access, privilege = ActionOnItems.global_group_access(group_name, registry)
+                if not known:
+                    print(f'WARN: Unknown global permission for group "{group_name}", no workspace wide access will be planned for it.')
+                if access is not None:
+                    emit(op='set_group_global_access', group=group_name, permission=access)
+                if privilege is not None:
+                    emit(op='workspace_privilege', group=group_name, privilege=privilege)
+                for member in members:
+                    emit(op='add_member_to_group', group=group_name, email=member.emailAddress, name=member.name, displayName=member.displayName, slug=member.slug)
+
+            flattener = PermissionFlattener(groups_to_migrate)
+            for project in server_structure:
+                for repo in project.repositories:
+                    for group_name, flattened_permission in flattener.flatten(project, repo):
+                        emit(op='add_group_to_repo', project=project.key, repo=repo.slug, repo_name=repo.name, group=group_name, permission=flattened_permission)
+
+        print(f'INFO: Wrote plan "{path}" with {counts["create_group"]} groups, {counts["add_member_to_group"]} group memberships, '
+              f'{counts["set_group_global_access"]} workspace wide group permissions and {counts["add_group_to_repo"]} repository group privileges')
+        return counts
+
+    @staticmethod
+    def read(path: str, *operations: str) -> Generator[dict, None, None]:
+        with open(path, encoding='utf-8') as plan_file:
+            for line in plan_file:
+                if not line.strip():
+                    continue
+                operation = json.loads(line)
+                if operation.get('op') in operations:
+                    yield operation
+
+    @staticmethod
+    def apply(path: str, cloud: CloudInstance, checkpoint: Checkpoint=None, cloud_state: CloudState=None) -> dict:
+        '''
+        Pushes a plan to the workspace in three passes over the file, each run with as much parallelism as the cloud allows:
+        groups are created first, then their workspace wide access and memberships, then every repository group privilege.
+        Operations for groups that failed to be created and repos that are not in the workspace yet are skipped.
+        The workspace membership of every planned member is looked up up front, as by ActionOnItems.mirror_groups, so
+        memberships of users that aren't in the workspace yet are queued without a request and reported together.
+        '''
+        window = cloud.max_workers * 4
+        write = lambda key, function, *args: ActionOnItems._write(checkpoint, cloud_state, key, function, cloud, *args)
+        group_workspace_privileges = {'create_repositories': [], 'admin_workspace': []}
+        created_groups = set()
+        skipped_memberships = {}
+        counts = Counter()
+        planned = Counter(operation['op'] for operation in MigrationPlan.read(path, 'create_group', 'add_member_to_group', 'add_group_to_repo'))
+        for phase, op in [('groups', 'create_group'), ('memberships', 'add_member_to_group'), ('privileges', 'add_group_to_repo')]:
+            progress.add_total(phase, planned[op])
+
+        member_index = WorkspaceMemberIndex(cloud)
+        if cloud_state is not None:
+            cloud_state.use_member_index(member_index)
+        member_index.load(operation['email'] for operation in MigrationPlan.read(path, 'add_member_to_group'))
+
+        with ThreadPoolExecutor(max_workers=cloud.max_workers) as executor:
+            create = lambda operation: write(('create_group', operation['group']), CA.create_group, operation['group'])
+            for operation, success in bounded_map(executor, create, MigrationPlan.read(path, 'create_group'), window):
+                progress.advance('groups')
+                if success:
+                    created_groups.add(operation['group'])
+                else:
+                    progress.fail('groups', 'write_failed', operation='create_group', group=operation['group'])
+                    print(f'WARN: Failed to mirror group "{operation["group"]}" to your cloud instance for unknown reason.')
+
+            def add_to_group(operation: dict) -> bool:
+                if operation['group'] not in created_groups:
+                    return None
+                if operation['op'] == 'workspace_privilege':
+                    return True
+                if operation['op'] == 'set_group_global_access':
+                    return write(('set_group_global_access', operation['group'], operation['permission']),
+                                 CA.set_group_global_access, operation['group'], operation['permission'])
+                if member_index.is_member(operation['email']) is False:
+                    return None
+                member = User(operation.get('name'), operation.get('email'), operation.get('displayName'), operation.get('slug'))
+                return write(('add_member_to_group', operation['group'], member.emailAddress), CA.add_member_to_group, operation['group'], member)
+
+            group_operations = MigrationPlan.read(path, 'workspace_privilege', 'set_group_global_access', 'add_member_to_group')
+            for operation, success in bounded_map(executor, add_to_group, group_operations, window):
+                counts[(operation['op'], success)] += 1
+                if operation['op'] == 'add_member_to_group':
+                    progress.advance('memberships')
+                if success and operation['op'] == 'workspace_privilege':
+                    group_workspace_privileges.get(operation['privilege']).append(operation['group'])
+                elif success is False and operation['op'] == 'set_group_global_access':
+                    print(f'WARN: Failed to apply global permissions to {operation["group"]} within your cloud instance.')
+                elif success is None and operation['op'] == 'add_member_to_group':
+                    reason = 'user_not_in_workspace' if operation['group'] in created_groups else 'group_not_created'
+                    if reason == 'user_not_in_workspace':
+                        skipped_memberships[operation['email']] = skipped_memberships.get(operation['email'], 0) + 1
+                    progress.fail('memberships', reason, operation='add_member_to_group', group=operation['group'], email=operation['email'])
+                    retry_queue.add(reason, 'add_member_to_group', group=operation['group'], email=operation['email'])
+                elif success is False:
+                    progress.fail('memberships', 'write_failed', operation='add_member_to_group', group=operation['group'], email=operation['email'])
+                    retry_queue.add('write_failed', 'add_member_to_group', group=operation['group'], email=operation['email'])
+                    print(f'WARN: Failed to add "{operation["email"]}" to group "{operation["group"]}" within your cloud instance.')
+
+            cloud_repos = CA.get_repo_slugs(cloud)
+            def add_to_repo(operation: dict) -> bool:
+                if operation['group'] not in created_groups or operation['repo'] not in cloud_repos:
+                    return None
+                return write(('add_group_to_repo', operation['group'], operation['repo'], operation['permission']),
+                             CA.add_group_to_repo, operation['repo'], operation['group'], operation['permission'])
+
+            for operation, success in bounded_map(executor, add_to_repo, MigrationPlan.read(path, 'add_group_to_repo'), window):
+                counts[(operation['op'], success)] += 1
+                progress.advance('privileges')
+                if success is None:
+                    reason = 'repo_not_migrated' if operation['group'] in created_groups else 'group_not_created'
+                    progress.fail('privileges', reason, operation='add_group_to_repo', group=operation['group'], repo=operation['repo'], permission=operation['permission'])
+                    retry_queue.add(reason, 'add_group_to_repo', group=operation['group'], repo=operation['repo'], permission=operation['permission'])
+                elif success is False:
+                    progress.fail('privileges', 'write_failed', operation='add_group_to_repo', group=operation['group'], repo=operation['repo'], permission=operation['permission'])
+                    retry_queue.add('write_failed', 'add_group_to_repo', group=operation['group'], repo=operation['repo'], permission=operation['permission'])
+                    print(f'WARN: Failed to add group "{operation["group"]}" with permission "{operation["permission"]}" to "{operation["repo_name"]}".')
+
+        for phase in ['groups', 'memberships', 'privileges']:
+            progress.finish(phase)
+        print(f'INFO: Applied plan "{path}": mirrored {len(created_groups)} groups with {counts[("add_member_to_group", True)]} group membership assignments '
+              f'({counts[("add_member_to_group", False)]} failed, {counts[("add_member_to_group", None)]} skipped as the user or group is not in your cloud workspace) and {counts[("add_group_to_repo", True)]} repository group privileges '
+              f'({counts[("add_group_to_repo", False)]} failed, {counts[("add_group_to_repo", None)]} skipped as the repo or group is not in your cloud workspace)')
+        ActionOnItems.report_skipped_memberships(skipped_memberships)
+        return group_workspace_privileges
@@ -0,0 +1,154 @@
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread
+from time import monotonic
+import json
+
+
+# The phases of a run in the order they are reported, and the items each one counts
+PHASES = {'scan': 'projects', 'groups': 'groups', 'memberships': 'memberships', 'repos': 'repos', 'privileges': 'repo privileges'}
+
+
+def duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3_600:
+        return f'{seconds // 3_600}h{seconds % 3_600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class PhaseStats:
+    def __init__(self):
+        self.total = None
+        self.done = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self) -> float:
+        return ((self.finished or monotonic()) - self.started) if self.started is not None else 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def remaining(self) -> float:
+        '''estimated seconds left, None while the total isn't known or nothing is done yet'''
+        if self.total is None or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def status(self, unit: str) -> str:
+        counted = f'{self.done}/{self.total}' if self.total is not None else f'{self.done}'
+        failed = f', {self.failed} failed' if self.failed else ''
+        if self.finished is not None:
+            return f'{counted} {unit} done in {duration(self.elapsed)}{failed}'
+        eta = f', ETA {duration(self.remaining)}' if self.remaining is not None else ''
+        return f'{counted} {unit} ({self.rate:.1f}/s{eta}{failed})'
+
+
+class Progress:
+    '''
+    Tracks the items handled per phase of a run (projects scanned, groups, memberships and repos mirrored, or the repo
+    privileges of an applied plan), shared by
+    every worker. The rate and remaining time of each phase are estimated from the items done so far and its known
+    total, which may grow while the phase runs (e.g. in streaming mode).
+
+    A background thread prints a single status line every "interval" seconds while a run is reporting, and failures are
+    appended to a JSON lines log as they happen rather than collected in memory. Every update is a counter increment
+    under a lock, so reporting is cheap enough to leave on.
+    '''
+    def __init__(self):
+        self.phases = {phase: PhaseStats() for phase in PHASES}
+        self.lock = Lock()
+        self.failure_log = None
+        self.failure_log_path = None
+        self.stopped = Event()
+        self.reporter = None
+
+    def clear(self) -> None:
+        with self.lock:
+            self.phases = {phase: PhaseStats() for phase in PHASES}
+
+    def add_total(self, phase: str, items: int) -> None:
+        # starts the phase if it hasn't started yet, phases with nothing to do are left out
+        if not items:
+            return
+        with self.lock:
+            stats = self.phases[phase]
+            if stats.started is None:
+                stats.started = monotonic()
+            stats.total = (stats.total or 0) + items
+            stats.finished = None
+
+    def advance(self, phase: str, items: int=1) -> None:
+        # counts handled items, whether they succeeded or failed
+        with self.lock:
+            stats = self.phases[phase]
+            if stats.started is None:
+                stats.started = monotonic()
+            stats.done += items
+
+    def finish(self, phase: str) -> None:
+        with self.lock:
+            stats = self.phases[phase]
+            if stats.started is not None:
+                stats.finished = monotonic()
+
+    def open_failure_log(self, path: str) -> None:
+        # the file is only created once something fails
+        self.failure_log_path = path
+
+    def fail(self, phase: str, reason: str, **details: str) -> None:
+        '''Counts and logs one failed item e.g. fail("memberships", "user_not_in_workspace", group="developers", email="jane@example.com")'''
+        record = {'time': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'phase': phase, 'reason': reason, **details}
+        with self.lock:
+            self.phases[phase].failed += 1
+            if self.failure_log is None and self.failure_log_path is not None:
+                self.failure_log = open(self.failure_log_path, 'a', encoding='utf-8')
+            if self.failure_log is not None:
+                self.failure_log.write(json.dumps(record) + '\n')
+                self.failure_log.flush()
+
+    def status(self) -> str:
+        with self.lock:
+            return ' | '.join(f'{phase} {stats.status(PHASES[phase])}' for phase, stats in self.phases.items() if stats.started is not None)
+
+    def start_reporting(self, interval: float) -> None:
+        if not interval:
+            return
+        self.stopped.clear()
+        def report() -> None:
+            while not self.stopped.wait(interval):
+                status = self.status()
+                if status:
+                    print(f'INFO: Progress - {status}', flush=True)
+        self.reporter = Thread(target=report, name='progress', daemon=True)
+        self.reporter.start()
+
+    def stop_reporting(self) -> None:
+        self.stopped.set()
+        if self.reporter is not None:
+            self.reporter.join()
+            self.reporter = None
+        if self.failure_log is not None:
+            self.failure_log.close()
+            self.failure_log = None
+
+    def print_summary(self) -> None:
+        status = self.status()
+        if not status:
+            return
+        print('\n\n----- Progress summary -----')
+        with self.lock:
+            for phase, stats in self.phases.items():
+                if stats.started is not None:
+                    print(f'{phase:<12}{stats.done:>9} {PHASES[phase]:<12}{stats.failed:>7} failed {duration(stats.elapsed):>9} {stats.rate:>9.1f}/s')
+            failed = sum(stats.failed for stats in self.phases.values())
+        if failed and self.failure_log_path is not None:
+            print(f'Failures were logged to "{self.failure_log_path}"')
+
+
+progress = Progress()
@@ -0,0 +1,173 @@
+from collections import deque
+from email.utils import parsedate_to_datetime
+from requests import Response
+from threading import Lock
+from time import monotonic, sleep, time
+import random
+
+
+class TokenBucket:
+    '''
+    Classic token bucket, refilled continuously at "rate" tokens per second up to "capacity".
+    A rate of None leaves the bucket unlimited.
+    '''
+    def __init__(self, rate: float=None, capacity: float=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate or 1, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def set_rate(self, rate: float, capacity: float=None) -> None:
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            if capacity:
+                self.capacity = capacity
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                if self.rate is None:
+                    return
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def _refill(self) -> None:
+        now = monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    '''
+    Client side pacing for every request sent to a single host.
+
+    Requests are paced by a token bucket whose rate starts at the configured "requests_per_second" (or unlimited)
+    and is adapted from the rate limit headers returned by Bitbucket:
+        Server/DC - X-RateLimit-Limit, X-RateLimit-Fill-Rate, X-RateLimit-Interval-Seconds
+        Cloud     - X-RateLimit-Limit (per hour), X-RateLimit-NearLimit
+    The adapted rate is kept at "headroom" of what the host reports so requests run just under the limit.
+
+    When a 429 is received every thread sharing the limiter pauses for the Retry-After period (or an exponential
+    backoff with jitter when the header is missing) and the rate is cut back, then gradually restored with each
+    successful response, rather than every worker sleeping a fixed minute on its own. 5xx responses are retried
+    with the same backoff up to "max_retries" times before being handed back to the caller.
+    '''
+    def __init__(self, requests_per_second: float=None, burst: int=None, headroom: float=0.9,
+                 base_backoff: float=1.0, max_backoff: float=60.0, max_retries: int=5):
+        self.ceiling = requests_per_second
+        self.share = 1.0
+        self.headroom = headroom
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.paused_until = 0.0
+        self.recent = deque(maxlen=100)
+        self.lock = Lock()
+
+    def set_share(self, share: float) -> None:
+        '''Keeps to "share" of the request budget, for when several processes send requests with the same account'''
+        self.share = share
+        if self.ceiling:
+            self.ceiling *= share
+            self.bucket.set_rate(self.ceiling, max(self.ceiling, 1))
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                wait = self.paused_until - monotonic()
+            if wait <= 0:
+                break
+            sleep(wait)
+        self.bucket.acquire()
+        with self.lock:
+            self.recent.append(monotonic())
+
+    def should_retry(self, status_code: int, attempt: int) -> bool:
+        if status_code == 429:
+            return True
+        return status_code >= 500 and attempt < self.max_retries
+
+    def observe(self, r: Response) -> None:
+        headers = r.headers
+        limit = self._number(headers.get('X-RateLimit-Limit'))
+        fill_rate = self._number(headers.get('X-RateLimit-Fill-Rate'))
+        interval = self._number(headers.get('X-RateLimit-Interval-Seconds'))
+        if fill_rate and interval:
+            # Bitbucket Server/DC token bucket: "fill_rate" tokens are added every "interval" seconds
+            self._adapt(fill_rate / interval * self.headroom * self.share, limit * self.share if limit else None)
+        elif headers.get('X-RateLimit-NearLimit', '').lower() == 'true' and limit:
+            # Bitbucket Cloud limits are expressed per hour, slow down to that rate once we're close to it
+            self._adapt(limit / 3_600 * self.headroom * self.share)
+        elif r.status_code < 400:
+            self._recover()
+
+    def backoff(self, r: Response, attempt: int) -> float:
+        '''Returns how long to wait before retrying "r", pausing every other request to this host for 429s'''
+        delay = self._retry_after(r.headers.get('Retry-After'))
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        else:
+            delay += random.uniform(0, self.base_backoff)
+        if r.status_code == 429:
+            with self.lock:
+                self.paused_until = max(self.paused_until, monotonic() + delay)
+                observed = self._observed_rate()
+            current = self.bucket.rate or observed
+            if current:
+                self._adapt(current * 0.75)
+        return delay
+
+    def _adapt(self, rate: float, capacity: float=None) -> None:
+        if self.ceiling:
+            rate = min(rate, self.ceiling)
+        self.bucket.set_rate(max(rate, 0.1), capacity)
+
+    def _recover(self) -> None:
+        # Gradually lift a cut back rate towards the configured ceiling, or back to unlimited once it's no longer the constraint
+        rate = self.bucket.rate
+        if rate is None or rate == self.ceiling:
+            return
+        rate *= 1.02
+        if self.ceiling and rate >= self.ceiling:
+            rate = self.ceiling
+        elif not self.ceiling:
+            with self.lock:
+                observed = self._observed_rate()
+            if observed and rate > 2 * observed:
+                rate = None
+        self.bucket.set_rate(rate)
+
+    def _observed_rate(self) -> float:
+        if len(self.recent) < 2:
+            return None
+        elapsed = self.recent[-1] - self.recent[0]
+        return (len(self.recent) - 1) / elapsed if elapsed > 0 else None
+
+    @staticmethod
+    def _retry_after(value: str) -> float:
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _number(value: str) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
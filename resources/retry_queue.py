@@ -0,0 +1,86 @@
+from collections import Counter
+from threading import Lock
+import json
+import os
+
+
+class RetryQueue:
+    '''
+    Group memberships and repository group privileges that couldn't be mirrored yet, persisted as JSON lines so they
+    can be re-attempted on their own with --retry once the users and repos they need have been migrated:
+        {"reason": "user_not_in_workspace", "op": "add_member_to_group", "group": ..., "email": ...}
+        {"reason": "repo_not_migrated", "op": "add_group_to_repo", "group": ..., "repo": ..., "permission": ...}
+    Reasons are "user_not_in_workspace", "repo_not_migrated", "group_not_created" and "write_failed".
+
+    Items are appended as they fail, and only the latest entry of an item counts. Every run that writes to the
+    workspace starts from an empty queue, as what it queues supersedes an earlier run's items: those it has since
+    mirrored, or that changed or were removed on the server, would otherwise be re-sent by --retry.
+    '''
+    def __init__(self):
+        self.path = None
+        self.queue_file = None
+        self.lock = Lock()
+
+    def open(self, path: str, replace: bool=False) -> None:
+        # the file is only created once something is queued, with "replace" an existing queue is emptied first
+        self.path = path
+        if replace and os.path.exists(path):
+            cleared = self.load()
+            self.rewrite([])
+            if cleared:
+                print(f'INFO: Cleared {len(cleared)} items queued by an earlier run from "{path}", this run queues whatever it still can\'t mirror')
+
+    def add(self, reason: str, op: str, **item: str) -> None:
+        if self.path is None:
+            return
+        with self.lock:
+            if self.queue_file is None:
+                self.queue_file = open(self.path, 'a', encoding='utf-8')
+            self.queue_file.write(json.dumps({'reason': reason, 'op': op, **item}) + '\n')
+            self.queue_file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.queue_file is not None:
+                self.queue_file.close()
+                self.queue_file = None
+
+    @staticmethod
+    def key(item: dict) -> tuple:
+        if item['op'] == 'add_member_to_group':
+            return item['op'], item['group'], item['email'].lower()
+        # a later entry for the same group on the same repo supersedes an earlier permission
+        return item['op'], item['group'], item['repo']
+
+    def load(self) -> list[dict]:
+        '''returns the queued items, the latest entry of each'''
+        items = {}
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding='utf-8') as queue_file:
+            for line in queue_file:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may have been cut short if the previous run was killed mid-write
+                    continue
+                items.pop(self.key(item), None)
+                items[self.key(item)] = item
+        return list(items.values())
+
+    def rewrite(self, items: list[dict]) -> None:
+        # Written to a temporary file first so an interrupted rewrite never loses the queue
+        self.close()
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as queue_file:
+            for item in items:
+                queue_file.write(json.dumps(item) + '\n')
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def summary(items: list[dict]) -> str:
+        reasons = Counter(item['reason'] for item in items)
+        return ', '.join(f'{count} {reason}' for reason, count in sorted(reasons.items())) or 'nothing'
+
+
+retry_queue = RetryQueue()
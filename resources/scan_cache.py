@@ -0,0 +1,100 @@
+from resources.instance_actions import GlobalGroup, Group, Project, Repository
+from resources.sharding import Shard
+from dataclasses import asdict
+from time import time
+import json
+import os
+
+
+def project_from_dict(project_data: dict) -> Project:
+    project = Project(project_data.get('key'), project_data.get('name'), project_data.get('public'), project_data.get('default_permission'))
+    project.groups = [Group(group_data.get('name'), group_data.get('permission')) for group_data in project_data.get('groups', [])]
+    for repo_data in project_data.get('repositories', []):
+        repo = Repository(repo_data.get('slug'), repo_data.get('name'), repo_data.get('default_permission'))
+        repo.groups = [Group(group_data.get('name'), group_data.get('permission')) for group_data in repo_data.get('groups', [])]
+        project.repositories.append(repo)
+    return project
+
+
+class ScanCache:
+    '''
+    Persists the result of ServerDetails.scan_server_structure to a JSON lines file so that re-runs can skip the server crawl.
+
+    The first line holds the global groups and groups_to_migrate, every following line holds one project (with its
+    repositories and groups) along with the time it was scanned. A cached project is considered stale, and is
+    re-scanned on the next run, when it is older than "max_age_hours", its key is listed in "stale_projects" or it is
+    owned by "stale_slice", which the watch mode rotates to re-scan a slice of the projects on every cycle.
+    With "detect_changes" the project and repo listings are re-read so new/removed projects and repos are picked up.
+
+    A run limited to a slice of the server only scans and saves that slice, so the header also records the fingerprint
+    of the run's scope (see resources/scope.py). A cache saved under a different scope is treated as absent.
+    '''
+    version = 1
+
+    def __init__(self, path: str, max_age_hours: float=None, stale_projects: list[str]=None, detect_changes: bool=False, scope: str=None):
+        self.path = path
+        self.scope = scope
+        self.max_age_hours = max_age_hours
+        self.stale_projects = set(stale_projects or [])
+        self.stale_slice: Shard = None
+        self.detect_changes = detect_changes
+        self.saved_at = None
+        self.global_groups = []
+        self.groups_to_migrate = []
+        self.projects = {}
+        self.scanned_at = {}
+
+    def load(self, accept_unscoped: bool=False) -> bool:
+        '''
+        returns False when there is no usable cache at "path", e.g. one saved under a different scope.
+        With "accept_unscoped" a cache of the whole server is used as well, for callers that apply the scope themselves.
+        '''
+        if not os.path.exists(self.path):
+            return False
+        # a cache may be loaded again, e.g. on every cycle of the watch mode
+        self.projects, self.scanned_at = {}, {}
+        with open(self.path, encoding='utf-8') as cache_file:
+            header = json.loads(cache_file.readline() or '{}')
+            if header.get('version') != self.version:
+                print(f'WARN: Ignoring scan cache "{self.path}" as it was written by an incompatible version of this script.')
+                return False
+            saved_scope = header.get('scope')
+            if saved_scope != self.scope and not (accept_unscoped and saved_scope is None):
+                print(f'WARN: Ignoring scan cache "{self.path}" as it was saved by a run limited to a different slice of the server. '
+                      'Keep one cache file per scope to reuse them.')
+                return False
+            self.saved_at = header.get('saved_at')
+            self.global_groups = [GlobalGroup(group_data.get('name'), group_data.get('permission')) for group_data in header.get('global_groups', [])]
+            self.groups_to_migrate = header.get('groups_to_migrate', [])
+            for line in cache_file:
+                entry = json.loads(line)
+                project = project_from_dict(entry.get('project'))
+                self.projects[project.key] = project
+                self.scanned_at[project.key] = entry.get('scanned_at')
+        return True
+
+    def is_stale(self, project_key: str) -> bool:
+        if project_key not in self.projects or project_key in self.stale_projects:
+            return True
+        if self.stale_slice is not None and self.stale_slice.owns(project_key):
+            return True
+        if self.max_age_hours is None:
+            return False
+        return time() - self.scanned_at.get(project_key, 0) > self.max_age_hours * 3_600
+
+    def mark_scanned(self, project_key: str) -> None:
+        self.scanned_at[project_key] = time()
+
+    def save(self, groups_to_migrate: list[str], global_groups: list[GlobalGroup], server_structure: list[Project]) -> None:
+        self.saved_at = time()
+        header = {'version': self.version, 'saved_at': self.saved_at, 'scope': self.scope, 'global_groups': [asdict(group) for group in global_groups],
+                  'groups_to_migrate': list(groups_to_migrate)}
+        # Written to a temporary file first so an interrupted save never leaves a truncated cache behind,
+        # named per process as every shard of a sharded run saves the cache it shares
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(json.dumps(header, separators=(',', ':')) + '\n')
+            for project in server_structure:
+                entry = {'scanned_at': self.scanned_at.get(project.key, self.saved_at), 'project': asdict(project)}
+                cache_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        os.replace(temp_path, self.path)
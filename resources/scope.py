@@ -0,0 +1,132 @@
+from dataclasses import replace
+from fnmatch import fnmatch
+from typing import Iterable
+import hashlib
+import json
+import re
+
+
+class NameFilter:
+    '''
+    Include/exclude patterns for one kind of name, matched case-insensitively. A pattern is a glob (e.g. "JIRA-*")
+    or, prefixed with "re:", a regular expression that must match the whole name (e.g. "re:confluence-.*").
+    A name is kept when it matches an include pattern (or none were given) and no exclude pattern.
+    '''
+    def __init__(self, include: list[str]=None, exclude: list[str]=None):
+        self.patterns = {'include': list(include or []), 'exclude': list(exclude or [])}
+        self.include = [NameFilter.compile(pattern) for pattern in include or []]
+        self.exclude = [NameFilter.compile(pattern) for pattern in exclude or []]
+
+    @staticmethod
+    def compile(pattern: str):
+        if pattern.startswith('re:'):
+            try:
+                expression = re.compile(pattern[3:], re.IGNORECASE)
+            except re.error as error:
+                raise ValueError(f'"{pattern}" is not a valid regular expression: {error}')
+            return lambda name: expression.fullmatch(name) is not None
+        pattern = pattern.lower()
+        return lambda name: fnmatch(name.lower(), pattern)
+
+    @property
+    def active(self) -> bool:
+        return bool(self.include or self.exclude)
+
+    def keeps(self, *names: str) -> bool:
+        '''True when any of "names" (e.g. a repo's slug and "PROJECT/slug") is included and none is excluded'''
+        if self.include and not any(match(name) for match in self.include for name in names):
+            return False
+        return not any(match(name) for match in self.exclude for name in names)
+
+
+class Scope:
+    '''
+    Limits a run to a slice of the server instance, e.g. one migration wave. The filters are checked as the server is
+    listed (see ServerActions.get_projects/get_repos and the group permission listings), so nothing is requested for the
+    projects and repos that are out of scope, and groups that are out of scope are never mirrored.
+
+    "migrated_repos" further limits the repos to the ones already migrated to cloud (e.g. by BCMA), each given as
+    "PROJECT_KEY/repo_slug" or just "repo_slug". When every entry has its project key, projects without any of them
+    aren't scanned at all.
+    When repos are limited, projects left without any repo in scope are dropped so their groups aren't mirrored.
+    '''
+    def __init__(self, projects: NameFilter=None, repos: NameFilter=None, groups: NameFilter=None, migrated_repos: Iterable[str]=None):
+        self.projects = projects or NameFilter()
+        self.repos = repos or NameFilter()
+        self.groups = groups or NameFilter()
+        self.migrated_repos = None
+        self.migrated_projects = None
+        if migrated_repos is not None:
+            self.migrated_repos = {repo.strip().lower() for repo in migrated_repos}
+            if all('/' in repo for repo in self.migrated_repos):
+                self.migrated_projects = {repo.split('/', 1)[0] for repo in self.migrated_repos}
+
+    @staticmethod
+    def read_repo_list(path: str) -> list[str]:
+        '''Reads one repo per line, ignoring blank lines and "#" comments'''
+        try:
+            with open(path, encoding='utf-8') as repo_list:
+                lines = [line.split('#', 1)[0].strip() for line in repo_list]
+        except OSError as error:
+            exit(f'FATAL: Could not read the list of migrated repos "{path}": {error}. Closing...')
+        return [line for line in lines if line]
+
+    @property
+    def active(self) -> bool:
+        return self.projects.active or self.limits_repos or self.groups.active
+
+    @property
+    def limits_repos(self) -> bool:
+        return self.repos.active or self.migrated_repos is not None
+
+    @property
+    def fingerprint(self) -> str:
+        '''Identifies the slice of the server a scan cache was saved for, None when nothing is filtered'''
+        if not self.active:
+            return None
+        patterns = {'projects': self.projects.patterns, 'repos': self.repos.patterns, 'groups': self.groups.patterns,
+                    'migrated_repos': sorted(self.migrated_repos) if self.migrated_repos is not None else None}
+        return hashlib.sha256(json.dumps(patterns, sort_keys=True).encode()).hexdigest()
+
+    def includes_project(self, project_key: str) -> bool:
+        if self.migrated_projects is not None and project_key.lower() not in self.migrated_projects:
+            return False
+        return self.projects.keeps(project_key)
+
+    def includes_repo(self, project_key: str, repo_slug: str) -> bool:
+        path = f'{project_key}/{repo_slug}'
+        if self.migrated_repos is not None and not {repo_slug.lower(), path.lower()} & self.migrated_repos:
+            return False
+        return self.repos.keeps(repo_slug, path)
+
+    def includes_group(self, group_name: str) -> bool:
+        return self.groups.keeps(group_name)
+
+    def apply(self, server_structure: list) -> list:
+        '''
+        Filters an already built server structure (loaded from a scan cache or an export) in place of the listings,
+        returns copies of the projects in scope so the structure itself is left as it was
+        '''
+        projects = []
+        for project in server_structure:
+            if not self.includes_project(project.key):
+                continue
+            repositories = [replace(repo, groups=[group for group in repo.groups if self.includes_group(group.name)])
+                            for repo in project.repositories if self.includes_repo(project.key, repo.slug)]
+            project = replace(project, groups=[group for group in project.groups if self.includes_group(group.name)], repositories=repositories)
+            if self.keeps(project):
+                projects.append(project)
+        return projects
+
+    def keeps(self, project) -> bool:
+        # a scanned project is only dropped when repos are limited and none of its repos are in scope
+        return bool(project.repositories) or not self.limits_repos
+
+    def __str__(self) -> str:
+        parts = []
+        for name, name_filter in [('projects', self.projects), ('repos', self.repos), ('groups', self.groups)]:
+            if name_filter.active:
+                parts.append(f'{name} ({len(name_filter.include)} include/{len(name_filter.exclude)} exclude patterns)')
+        if self.migrated_repos is not None:
+            parts.append(f'{len(self.migrated_repos)} migrated repos')
+        return ', '.join(parts) or 'everything'
@@ -0,0 +1,122 @@
+from resources.instance_actions import GlobalGroup, Group, Project, Repository
+from resources.scan_cache import ScanCache
+from resources.scope import Scope
+from typing import Generator, Tuple
+import csv
+import json
+import os
+
+
+# perm_id values stored in the Bitbucket Server/DC permission tables, the ids of com.atlassian.bitbucket.permission.Permission
+PERMISSIONS = {
+    0: 'LICENSED_USER', 1: 'PROJECT_VIEW', 2: 'REPO_READ', 3: 'REPO_WRITE', 4: 'REPO_ADMIN',
+    5: 'PROJECT_READ', 6: 'PROJECT_WRITE', 7: 'PROJECT_ADMIN', 8: 'PROJECT_CREATE', 9: 'ADMIN', 10: 'SYS_ADMIN',
+}
+
+
+class ServerExport:
+    '''
+    Builds the server structure from a local export instead of crawling the REST api.
+
+    The export is either a scan cache saved with --cache, or a directory holding a dump of these Bitbucket database
+    tables, each as "<table>.csv" (with a header row) or "<table>.json" (a list of row objects):
+        project                (id, project_key, name, is_public[, project_type])
+        repository             (id, project_id, slug, name, is_public)
+        sta_global_permission  (perm_id, group_name[, user_id])
+        sta_project_permission (project_id, perm_id, group_name[, user_id])
+        sta_repo_permission    (repo_id, perm_id, group_name[, user_id])
+    perm_id may be a number (see PERMISSIONS) or the permission's name. Rows granted to a user rather than a group are
+    ignored, and project permission rows with neither a group nor a user are the project's default permission.
+    Personal projects (project_type 1) are skipped as they are by the api's project listing.
+    '''
+    @staticmethod
+    def load(path: str, scope: Scope=None) -> Tuple[list[GlobalGroup], list[Project]]:
+        # a scan cache must cover the whole server or the same "scope" as this run, which is applied by the caller
+        if os.path.isfile(path):
+            cache = ScanCache(path, scope=scope.fingerprint if scope is not None else None)
+            if not cache.load(accept_unscoped=True):
+                exit(f'FATAL: Could not read the scan cache "{path}". Closing...')
+            print(f'INFO: Loaded {len(cache.projects)} projects from the scan cache "{path}"')
+            return cache.global_groups, list(cache.projects.values())
+        if not os.path.isdir(path):
+            exit(f'FATAL: The export "{path}" is neither a scan cache file nor a directory of table exports. Closing...')
+        return ServerExport.load_tables(path)
+
+    @staticmethod
+    def load_tables(directory: str) -> Tuple[list[GlobalGroup], list[Project]]:
+        global_groups = [GlobalGroup(row['group_name'], ServerExport.permission(row['perm_id']))
+                         for row in ServerExport.rows(directory, 'sta_global_permission') if ServerExport.is_group_grant(row)]
+
+        projects = {}
+        for row in ServerExport.rows(directory, 'project', required=True):
+            if str(row.get('project_type') or '0') != '0':
+                continue
+            projects[row['id']] = Project(row['project_key'], row['name'], ServerExport.boolean(row.get('is_public')), None)
+
+        default_permissions = {}
+        for row in ServerExport.rows(directory, 'sta_project_permission'):
+            project = projects.get(row['project_id'])
+            if project is None:
+                continue
+            permission = ServerExport.permission(row['perm_id'])
+            if ServerExport.is_group_grant(row):
+                project.groups.append(Group(row['group_name'], permission))
+            elif not row.get('user_id'):
+                default_permissions.setdefault(row['project_id'], set()).add(permission)
+        for project_id, project in projects.items():
+            project.default_permission = ServerExport.project_default_permission(project, default_permissions.get(project_id, set()))
+
+        repositories = {}
+        for row in ServerExport.rows(directory, 'repository', required=True):
+            project = projects.get(row['project_id'])
+            if project is None:
+                continue
+            repo = Repository(row['slug'], row['name'], "Read" if ServerExport.boolean(row.get('is_public')) else "None")
+            project.repositories.append(repo)
+            repositories[row['id']] = repo
+
+        for row in ServerExport.rows(directory, 'sta_repo_permission'):
+            repo = repositories.get(row['repo_id'])
+            if repo is not None and ServerExport.is_group_grant(row):
+                repo.groups.append(Group(row['group_name'], ServerExport.permission(row['perm_id'])))
+
+        print(f'INFO: Loaded {len(projects)} projects and {len(repositories)} repositories from the table exports in "{directory}"')
+        return global_groups, list(projects.values())
+
+    @staticmethod
+    def rows(directory: str, table: str, required: bool=False) -> Generator[dict, None, None]:
+        # Streams a table's rows with lower cased column names and empty values as None
+        csv_path, json_path = os.path.join(directory, f'{table}.csv'), os.path.join(directory, f'{table}.json')
+        if os.path.exists(csv_path):
+            with open(csv_path, newline='', encoding='utf-8') as table_file:
+                for row in csv.DictReader(table_file):
+                    yield {column.strip().lower(): (value if value != '' else None) for column, value in row.items()}
+        elif os.path.exists(json_path):
+            with open(json_path, encoding='utf-8') as table_file:
+                for row in json.load(table_file):
+                    yield {column.lower(): (str(value) if value not in ('', None) else None) for column, value in row.items()}
+        elif required:
+            exit(f'FATAL: The "{table}" table export ({table}.csv or {table}.json) is missing from "{directory}". Closing...')
+        else:
+            print(f'WARN: No "{table}" table export ({table}.csv or {table}.json) was found in "{directory}", none of its permissions will be mirrored.')
+
+    @staticmethod
+    def permission(perm_id: str) -> str:
+        return PERMISSIONS.get(int(perm_id), perm_id) if perm_id.isdigit() else perm_id
+
+    @staticmethod
+    def is_group_grant(row: dict) -> bool:
+        return bool(row.get('group_name'))
+
+    @staticmethod
+    def boolean(value: str) -> bool:
+        return str(value).strip().lower() in ('1', 't', 'true', 'y', 'yes')
+
+    @staticmethod
+    def project_default_permission(project: Project, permissions: set[str]) -> str:
+        # Same precedence as ServerActions.get_project_default_permission
+        if permissions & {'PROJECT_WRITE', 'PROJECT_ADMIN'}:
+            return "Write"
+        if project.public or 'PROJECT_READ' in permissions:
+            return "Read"
+        return "None"
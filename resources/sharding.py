@@ -0,0 +1,112 @@
+from resources.instance_actions import CloudActions as CA
+from resources.instance_init import Instance, CloudInstance
+from bisect import bisect_right
+from time import monotonic, sleep
+from typing import Iterable
+import glob
+import json
+import os
+import zlib
+
+
+class Shard:
+    '''
+    One of "count" partitions of the server's projects, so that the cloud writes of a large instance can be split
+    between several processes or hosts that each run with their own sessions.
+
+    Projects are assigned by a crc32 hash of their key, or by "boundaries": the sorted project keys at which each
+    following shard starts, e.g. boundaries ["H", "P"] give shard 0 the keys before "H", shard 1 the keys from "H" and
+    shard 2 the keys from "P". Shard 0 is the designated shard, it alone creates the groups and their memberships.
+    The other shards only write the repository group privileges of their projects, once their groups exist.
+    '''
+    # How often the other shards check the workspace for the groups created by the designated shard
+    wait_interval = 15
+
+    def __init__(self, index: int, count: int, boundaries: list[str]=None):
+        if boundaries and len(boundaries) != count - 1:
+            raise ValueError(f'{len(boundaries)} shard range boundaries split the projects into {len(boundaries) + 1} shards, not {count}')
+        if not 0 <= index < count:
+            raise ValueError(f'shard {index} is not one of the shards 0 to {count - 1}')
+        self.index = index
+        self.count = count
+        self.boundaries = sorted(boundary.upper() for boundary in boundaries or [])
+
+    @classmethod
+    def parse(cls, shard: str, boundaries: list[str]=None) -> 'Shard':
+        '''parses "INDEX/COUNT" e.g. "0/4"'''
+        try:
+            index, count = (int(part) for part in shard.split('/'))
+        except ValueError:
+            raise ValueError(f'"{shard}" is not a shard in the form INDEX/COUNT, e.g. 0/4')
+        return cls(index, count, boundaries)
+
+    @property
+    def designated(self) -> bool:
+        return self.index == 0
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+    def owns(self, project_key: str) -> bool:
+        if self.boundaries:
+            return bisect_right(self.boundaries, project_key.upper()) == self.index
+        return zlib.crc32(project_key.encode()) % self.count == self.index
+
+    def share_request_budget(self, *instances: Instance) -> None:
+        # every shard keeps to its share of the request rate, workers and requests in flight of each instance
+        for instance in instances:
+            instance.set_share(1 / self.count)
+
+    def path(self, path: str) -> str:
+        # e.g. checkpoint.jsonl -> checkpoint.shard-1-of-4.jsonl
+        root, extension = os.path.splitext(path)
+        return f'{root}.shard-{self.index}-of-{self.count}{extension}'
+
+    def summary_path(self, directory: str) -> str:
+        return os.path.join(directory, f'shard-{self.index}-of-{self.count}.json')
+
+    def write_summary(self, directory: str, summary: dict) -> None:
+        os.makedirs(directory, exist_ok=True)
+        with open(self.summary_path(directory), 'w', encoding='utf-8') as summary_file:
+            json.dump({'shard': self.index, 'count': self.count, **summary}, summary_file, indent=2)
+
+    def wait_for_groups(self, cloud: CloudInstance, group_names: Iterable[str], timeout: float) -> list[str]:
+        '''
+        Waits up to "timeout" seconds for the designated shard to create "group_names" in the workspace.
+        returns the groups still missing, which are left to fail when their privileges are written
+        '''
+        group_names = list(group_names)
+        deadline = monotonic() + timeout
+        while True:
+            present = set()
+            for group_data in CA.get_groups(cloud):
+                present.update({group_data.get('name'), group_data.get('slug')} - {None})
+            missing = [group_name for group_name in group_names if group_name not in present]
+            if not missing or monotonic() >= deadline:
+                return missing
+            print(f'INFO: Shard {self} is waiting for {len(missing)} of {len(group_names)} groups to be created by shard 0/{self.count}...')
+            sleep(min(self.wait_interval, max(deadline - monotonic(), 0)))
+
+    @staticmethod
+    def merge_summaries(directory: str) -> tuple[dict, list[int], int]:
+        '''
+        Combines the summaries written by every shard to "directory".
+        returns the merged summary, the indexes of the shards found and the shard count they were run with
+        '''
+        merged = {'group_workspace_privileges': {'create_repositories': [], 'admin_workspace': []}, 'groups': 0, 'group_memberships': 0,
+                  'skipped_memberships': {}, 'successful_repos': 0, 'total_repos': 0}
+        shards = []
+        count = 0
+        for path in sorted(glob.glob(os.path.join(directory, 'shard-*-of-*.json'))):
+            with open(path, encoding='utf-8') as summary_file:
+                summary = json.load(summary_file)
+            shards.append(summary['shard'])
+            count = max(count, summary['count'])
+            for key in ['groups', 'group_memberships', 'successful_repos', 'total_repos']:
+                merged[key] += summary.get(key, 0)
+            for user_email, skipped in summary.get('skipped_memberships', {}).items():
+                merged['skipped_memberships'][user_email] = merged['skipped_memberships'].get(user_email, 0) + skipped
+            for privilege, group_names in summary.get('group_workspace_privileges', {}).items():
+                merged['group_workspace_privileges'].setdefault(privilege, []).extend(
+                    group_name for group_name in group_names if group_name not in merged['group_workspace_privileges'][privilege])
+        return merged, sorted(shards), count
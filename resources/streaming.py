@@ -0,0 +1,128 @@
+from resources.instance_actions import Project, ServerActions as SA, CloudActions as CA
+from resources.instance_init import ServerInstance, CloudInstance
+from resources.mirror_operations import ServerDetails, ActionOnItems
+from resources.checkpoint import Checkpoint
+from resources.cloud_state import CloudState
+from resources.permissions import PermissionFlattener
+from resources.member_index import WorkspaceMemberIndex
+from resources.group_registry import GroupRegistry
+from resources.progress import progress
+from resources.retry_queue import retry_queue
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StreamingMirror:
+    '''
+    Mirrors the server one project at a time, as each project finishes scanning, instead of scanning the whole
+    instance before the first cloud write. Reads of the following projects overlap the writes for the current one
+    and only a small window of projects is held in memory at once.
+
+    Global groups are mirrored first. Groups are otherwise discovered as projects are scanned, and any group first seen
+    in a project is mirrored (created, given its global access and members) before that project's repo privileges are
+    written. Repos with a default/public permission grant it to every group, so when a group is discovered after such
+    repos were already mirrored it is granted their default permission too, ending up with the same privileges as a
+    full scan would have given it.
+    '''
+    def __init__(self, server: ServerInstance, cloud: CloudInstance, checkpoint: Checkpoint=None, cloud_state: CloudState=None):
+        self.server = server
+        self.cloud = cloud
+        self.checkpoint = checkpoint
+        self.cloud_state = cloud_state
+        # where groups are used isn't tracked, it would grow with the instance
+        self.registry = GroupRegistry(track_usage=False)
+        self.flattener = PermissionFlattener([])
+        self.member_index = WorkspaceMemberIndex(cloud)
+        if cloud_state is not None:
+            cloud_state.use_member_index(self.member_index)
+        self.cloud_repos = set()
+        # (repo, default permission) of mirrored repos whose default permission applies to every group
+        self.defaulted_repos = []
+        # the same for repos that aren't in the workspace yet, their privileges are queued for --retry instead
+        self.unmigrated_defaulted_repos = []
+        self.group_workspace_privileges = {'create_repositories': [], 'admin_workspace': []}
+        self.skipped_memberships = {}
+        self.group_counter = 0
+        self.group_memberships = 0
+        self.successful_repo_counter = 0
+        self.total_repo_counter = 0
+
+    def run(self, window: int=None) -> dict:
+        for group in SA.get_group_global_permissions(self.server):
+            self.registry.add_global(group)
+        self.cloud_repos = CA.get_repo_slugs(self.cloud)
+        projects = ServerDetails.iter_project_and_repo_structure(self.server, window=window or self.server.max_workers * 2)
+        with ThreadPoolExecutor(max_workers=self.server.max_workers) as self.server_executor, \
+             ThreadPoolExecutor(max_workers=self.cloud.max_workers) as self.group_executor, \
+             ThreadPoolExecutor(max_workers=self.cloud.max_workers) as self.member_executor, \
+             ThreadPoolExecutor(max_workers=self.cloud.max_workers) as self.repo_executor, \
+             ThreadPoolExecutor(max_workers=self.cloud.max_workers) as self.write_executor:
+            self.mirror_groups(list(self.registry))
+            for project in projects:
+                self.mirror_groups(self.registry.register(project))
+                self.mirror_project(project)
+        for phase in ['groups', 'memberships', 'repos']:
+            progress.finish(phase)
+
+        ActionOnItems.report_group_totals(self.group_counter, self.group_memberships, self.skipped_memberships)
+        print(f'INFO: Successfully mirrored the groups/permissions for {self.successful_repo_counter} of {self.total_repo_counter} repositories.')
+        return {'group_workspace_privileges': self.group_workspace_privileges, 'groups': self.group_counter, 'group_memberships': self.group_memberships,
+                'skipped_memberships': self.skipped_memberships, 'successful_repos': self.successful_repo_counter, 'total_repos': self.total_repo_counter}
+
+    def mirror_groups(self, new_groups: list[str]) -> None:
+        # Mirrors newly discovered groups, then back-fills the default permission of already mirrored repos to them
+        if not new_groups:
+            return
+        for group_name in new_groups:
+            self.flattener.add(group_name)
+
+        list_members = lambda group_name: [self.member_index.intern(member) for member in SA.get_group_members(self.server, group_name)]
+        group_members = list(self.server_executor.map(list_members, new_groups))
+        self.member_index.load(member.emailAddress for members in group_members for member in members)
+        progress.add_total('groups', len(new_groups))
+        progress.add_total('memberships', sum(len(members) for members in group_members))
+        migrations = [self.group_executor.submit(ActionOnItems._mirror_group, self.cloud, group_name, members, self.registry, self.member_executor,
+                                                 self.member_index, self.checkpoint, self.cloud_state)
+                      for group_name, members in zip(new_groups, group_members)]
+        for group_name, migration in zip(new_groups, migrations):
+            migrated_users = ActionOnItems.report_group_migration(group_name, migration.result(), self.group_workspace_privileges, self.skipped_memberships)
+            if migrated_users is not None:
+                self.group_counter += 1
+                self.group_memberships += migrated_users
+
+        writes = []
+        for repo, default in self.defaulted_repos:
+            for group_name in new_groups:
+                key = ('add_group_to_repo', group_name, repo.slug, default.cloud_name)
+                writes.append((repo, group_name, default.cloud_name, self.write_executor.submit(ActionOnItems._write, self.checkpoint, self.cloud_state, key,
+                                                                                                CA.add_group_to_repo, self.cloud, repo.slug, group_name, default.cloud_name)))
+        for repo, default in self.unmigrated_defaulted_repos:
+            for group_name in new_groups:
+                retry_queue.add('repo_not_migrated', 'add_group_to_repo', group=group_name, repo=repo.slug, permission=default.cloud_name)
+        for repo, group_name, permission, write in writes:
+            if not write.result():
+                progress.fail('repos', 'write_failed', operation='add_group_to_repo', group=group_name, repo=repo.slug, permission=permission)
+                retry_queue.add('write_failed', 'add_group_to_repo', group=group_name, repo=repo.slug, permission=permission)
+                print(f'WARN: Failed to add group "{group_name}" with permission "{permission}" to "{repo.name}".')
+
+    def mirror_project(self, project: Project) -> None:
+        progress.add_total('repos', len(project.repositories))
+        mirrors = [(repo, self.repo_executor.submit(ActionOnItems._mirror_repo, self.cloud, self.cloud_repos, project, repo, self.flattener,
+                                                    self.write_executor, self.checkpoint, self.cloud_state))
+                   for repo in project.repositories]
+        for repo, mirror in mirrors:
+            atleast_one_group_migrated = ActionOnItems.report_repo_migration(repo, *mirror.result())
+            if atleast_one_group_migrated is None:
+                default = PermissionFlattener.default(project, repo)
+                if default:
+                    repo.groups = []
+                    self.unmigrated_defaulted_repos.append((repo, default))
+                continue
+            if atleast_one_group_migrated:
+                self.successful_repo_counter += 1
+            self.total_repo_counter += 1
+            default = PermissionFlattener.default(project, repo)
+            if default:
+                # only the slug and name are needed later, the repo's groups can be released
+                repo.groups = []
+                self.defaulted_repos.append((repo, default))
+        self.flattener.forget(project)
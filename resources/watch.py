@@ -0,0 +1,253 @@
+from resources.instance_actions import User, ServerActions as SA, CloudActions as CA
+from resources.instance_init import ServerInstance, CloudInstance
+from resources.mirror_operations import ServerDetails, ActionOnItems
+from resources.scan_cache import ScanCache
+from resources.cloud_state import CloudState
+from resources.permissions import PermissionFlattener
+from resources.member_index import WorkspaceMemberIndex
+from resources.progress import progress
+from resources.sharding import Shard
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep, time
+import json
+import os
+
+
+class PermissionSnapshot:
+    '''
+    The cloud side of a mirror: the groups, their workspace wide access, the group memberships (by email) and the
+    flattened repository group privileges. Built from a scan of the server for what should be in the workspace, and
+    persisted by the watch mode for what has been pushed to it so far.
+
+    "member_listings" holds the server's member listing of each group ({group: emails}), persisted alongside so that a
+    scan can list the members of only a slice of the groups and reuse the listings of the rest.
+    '''
+    version = 2
+
+    def __init__(self, groups: set=None, global_access: dict=None, memberships: set=None, privileges: dict=None, member_listings: dict=None):
+        self.groups = set(groups or ())
+        self.global_access = dict(global_access or {})  # group -> "read"/"write"/"admin"
+        self.memberships = set(memberships or ())        # (group, email)
+        self.privileges = dict(privileges or {})         # (repo slug, group) -> "read"/"write"/"admin"
+        self.member_listings = dict(member_listings or {})
+
+    @classmethod
+    def scan(cls, server: ServerInstance, cache: ScanCache=None, member_listings: dict=None, member_slice: Shard=None) -> 'PermissionSnapshot':
+        '''
+        With a "cache" only the projects it considers stale, and the repos new to their listings, are scanned again, see
+        ServerDetails.refresh_project_and_repo_structure. Members are listed again for groups missing from
+        "member_listings" and for the groups "member_slice" owns, or for every group without a slice.
+        '''
+        registry, _, server_structure = ServerDetails.scan_server_structure(server, cache)
+        snapshot = cls(registry)
+        for group_name in registry:
+            _, access, _ = ActionOnItems.global_group_access(group_name, registry)
+            if access is not None:
+                snapshot.global_access[group_name] = access
+
+        listings = {group_name: emails for group_name, emails in (member_listings or {}).items() if group_name in registry}
+        relist = [group_name for group_name in registry if group_name not in listings or member_slice is None or member_slice.owns(group_name)]
+        with ThreadPoolExecutor(max_workers=server.max_workers) as executor:
+            list_members = lambda group_name: [member.emailAddress for member in SA.get_group_members(server, group_name) if member.emailAddress]
+            for group_name, emails in zip(relist, executor.map(list_members, relist)):
+                listings[group_name] = emails
+        if len(relist) < len(registry):
+            print(f'INFO: Listed the members of {len(relist)} of {len(registry)} groups, the rest are reused from the last scan')
+        snapshot.member_listings = listings
+        for group_name, emails in listings.items():
+            snapshot.memberships.update((group_name, email) for email in emails)
+
+        flattener = PermissionFlattener(registry)
+        for project in server_structure:
+            for repo in project.repositories:
+                for group_name, permission in flattener.flatten(project, repo):
+                    snapshot.privileges[(repo.slug, group_name)] = permission
+        return snapshot
+
+    @classmethod
+    def present(cls, cloud_state: CloudState, wanted: 'PermissionSnapshot') -> 'PermissionSnapshot':
+        '''the part of "wanted" that is already in place in the workspace'''
+        return cls({group_name for group_name in wanted.groups if cloud_state.done('create_group', group_name)},
+                   {group_name: access for group_name, access in wanted.global_access.items() if cloud_state.done('set_group_global_access', group_name, access)},
+                   {(group_name, email) for group_name, email in wanted.memberships if cloud_state.done('add_member_to_group', group_name, email)},
+                   {(repo_slug, group_name): permission for (repo_slug, group_name), permission in wanted.privileges.items()
+                    if cloud_state.done('add_group_to_repo', group_name, repo_slug, permission)})
+
+    @classmethod
+    def load(cls, path: str) -> 'PermissionSnapshot':
+        '''returns None when there is no usable snapshot at "path"'''
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as snapshot_file:
+            data = json.load(snapshot_file)
+        if data.get('version') != cls.version:
+            print(f'WARN: Ignoring watch snapshot "{path}" as it was written by an incompatible version of this script.')
+            return None
+        return cls(data.get('groups'), data.get('global_access'), {tuple(membership) for membership in data.get('memberships', [])},
+                   {(repo_slug, group_name): permission for repo_slug, group_name, permission in data.get('privileges', [])},
+                   data.get('member_listings'))
+
+    def save(self, path: str) -> None:
+        data = {'version': self.version, 'saved_at': time(), 'groups': sorted(self.groups), 'global_access': self.global_access,
+                'memberships': sorted(self.memberships), 'privileges': sorted([*key, permission] for key, permission in self.privileges.items()),
+                'member_listings': self.member_listings}
+        # Written to a temporary file first so an interrupted save never leaves a truncated snapshot behind
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump(data, snapshot_file, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+
+class Watcher:
+    '''
+    Keeps the workspace in step with the server after cutover: every "interval" seconds the server is scanned again
+    and only the differences from what has been pushed so far are written to the workspace.
+
+    With a scan "cache" set to detect changes, each cycle re-reads the project listing and every project's default
+    permission and repo listing. The group permissions of every project and the members of every group are read again
+    too, unless "slices" splits them: then each cycle only re-reads one slice of the projects and groups in turn, besides
+    new repos and groups. A change is then pushed within "slices" cycles at the latest.
+
+    What has been pushed is persisted to "snapshot_path" after every cycle. Without a snapshot the first cycle reads
+    the workspace's groups and privileges once and only pushes what is missing. Writes that can't be made yet (users
+    not in the workspace, repos not migrated) or that fail are left out of the snapshot, so the next cycle attempts
+    them again. Grants removed on the server are only revoked in the workspace with "revoke", otherwise they are
+    reported and left in place.
+    '''
+    def __init__(self, server: ServerInstance, cloud: CloudInstance, snapshot_path: str, interval: float, revoke: bool=False,
+                 cache: ScanCache=None, slices: int=1):
+        self.server = server
+        self.cloud = cloud
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.revoke = revoke
+        self.cache = cache
+        self.slices = slices
+        self.pushed = PermissionSnapshot.load(snapshot_path)
+
+    def run(self, cycles: int=None) -> None:
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            cycle += 1
+            started = monotonic()
+            self.cycle(cycle)
+            if cycles is not None and cycle >= cycles:
+                return
+            wait = max(self.interval - (monotonic() - started), 0)
+            print(f'INFO: Watching for changes, next scan in {wait / 60:.1f} minutes')
+            sleep(wait)
+
+    def cycle(self, cycle: int) -> dict:
+        progress.clear()
+        member_listings = self.pushed.member_listings if self.pushed is not None else None
+        rotation = Shard((cycle - 1) % self.slices, self.slices)
+        if self.cache is not None:
+            self.cache.stale_slice = rotation
+        wanted = PermissionSnapshot.scan(self.server, self.cache, member_listings, rotation)
+        if self.pushed is None:
+            cloud_state, member_index = CloudState.load(self.cloud), WorkspaceMemberIndex(self.cloud)
+            cloud_state.use_member_index(member_index)
+            member_index.load(email for _, email in wanted.memberships)
+            self.pushed = PermissionSnapshot.present(cloud_state, wanted)
+            print(f'INFO: No watch snapshot was found at "{self.snapshot_path}", starting from what is already in your cloud workspace')
+
+        counts = {'groups': 0, 'global_access': 0, 'memberships': 0, 'privileges': 0, 'revoked': 0, 'waiting': 0, 'failed': 0}
+        with ThreadPoolExecutor(max_workers=self.cloud.max_workers) as executor:
+            self.push_groups(wanted, executor, counts)
+            self.push_memberships(wanted, executor, counts)
+            self.push_privileges(wanted, executor, counts)
+        self.pushed.member_listings = wanted.member_listings
+        self.pushed.save(self.snapshot_path)
+
+        print(f'INFO: Watch cycle {cycle} pushed {counts["groups"]} new groups, {counts["global_access"]} workspace wide group permissions, '
+              f'{counts["memberships"]} group memberships and {counts["privileges"]} repository group privileges, and revoked {counts["revoked"]} grants. '
+              f'{counts["waiting"]} are waiting on users or repos to be migrated and {counts["failed"]} failed.')
+        return counts
+
+    def push_groups(self, wanted: PermissionSnapshot, executor: ThreadPoolExecutor, counts: dict) -> None:
+        new_groups = sorted(wanted.groups - self.pushed.groups)
+        for group_name, success in zip(new_groups, executor.map(lambda group_name: CA.create_group(self.cloud, group_name), new_groups)):
+            if success:
+                self.pushed.groups.add(group_name)
+                counts['groups'] += 1
+            else:
+                counts['failed'] += 1
+                progress.fail('groups', 'write_failed', operation='create_group', group=group_name)
+        for group_name in self.pushed.groups - wanted.groups:
+            print(f'WARN: Group "{group_name}" is no longer granted any permission within Bitbucket Server, it is left in your cloud workspace.')
+            self.pushed.groups.discard(group_name)
+
+        changed = sorted((group_name, access) for group_name, access in wanted.global_access.items()
+                         if group_name in self.pushed.groups and self.pushed.global_access.get(group_name) != access)
+        set_access = lambda change: CA.set_group_global_access(self.cloud, *change)
+        for (group_name, access), success in zip(changed, executor.map(set_access, changed)):
+            if success:
+                self.pushed.global_access[group_name] = access
+                counts['global_access'] += 1
+            else:
+                counts['failed'] += 1
+                progress.fail('groups', 'write_failed', operation='set_group_global_access', group=group_name, permission=access)
+        for group_name in self.pushed.global_access.keys() - wanted.global_access.keys():
+            # the groups api can't take a group's workspace wide access away again
+            print(f'WARN: Group "{group_name}" no longer has a global permission within Bitbucket Server, remove its workspace wide access by hand.')
+            del self.pushed.global_access[group_name]
+
+    def push_memberships(self, wanted: PermissionSnapshot, executor: ThreadPoolExecutor, counts: dict) -> None:
+        additions = sorted(membership for membership in wanted.memberships - self.pushed.memberships if membership[0] in self.pushed.groups)
+        member_index = WorkspaceMemberIndex(self.cloud)
+        member_index.load(email for _, email in additions)
+        waiting = [membership for membership in additions if member_index.is_member(membership[1]) is False]
+        counts['waiting'] += len(waiting)
+        additions = [membership for membership in additions if member_index.is_member(membership[1]) is not False]
+        add = lambda membership: CA.add_member_to_group(self.cloud, membership[0], User(None, membership[1], None, None))
+        for (group_name, email), success in zip(additions, executor.map(add, additions)):
+            if success:
+                self.pushed.memberships.add((group_name, email))
+                counts['memberships'] += 1
+            else:
+                counts['failed'] += 1
+                progress.fail('memberships', 'write_failed', operation='add_member_to_group', group=group_name, email=email)
+
+        removals = sorted(self.pushed.memberships - wanted.memberships)
+        if removals and not self.revoke:
+            print(f'WARN: {len(removals)} group memberships were removed within Bitbucket Server, re-run with --revoke to remove them from your cloud workspace too.')
+            self.pushed.memberships.difference_update(removals)
+            return
+        remove = lambda membership: CA.remove_member_from_group(self.cloud, *membership)
+        for (group_name, email), success in zip(removals, executor.map(remove, removals)):
+            if success:
+                self.pushed.memberships.discard((group_name, email))
+                counts['revoked'] += 1
+            else:
+                counts['failed'] += 1
+                progress.fail('memberships', 'write_failed', operation='remove_member_from_group', group=group_name, email=email)
+
+    def push_privileges(self, wanted: PermissionSnapshot, executor: ThreadPoolExecutor, counts: dict) -> None:
+        cloud_repos = CA.get_repo_slugs(self.cloud)
+        changed = sorted((repo_slug, group_name, permission) for (repo_slug, group_name), permission in wanted.privileges.items()
+                         if group_name in self.pushed.groups and self.pushed.privileges.get((repo_slug, group_name)) != permission)
+        counts['waiting'] += sum(repo_slug not in cloud_repos for repo_slug, _, _ in changed)
+        changed = [change for change in changed if change[0] in cloud_repos]
+        add = lambda change: CA.add_group_to_repo(self.cloud, *change)
+        for (repo_slug, group_name, permission), success in zip(changed, executor.map(add, changed)):
+            if success:
+                self.pushed.privileges[(repo_slug, group_name)] = permission
+                counts['privileges'] += 1
+            else:
+                counts['failed'] += 1
+                progress.fail('repos', 'write_failed', operation='add_group_to_repo', group=group_name, repo=repo_slug, permission=permission)
+
+        removals = sorted(self.pushed.privileges.keys() - wanted.privileges.keys())
+        if removals and not self.revoke:
+            print(f'WARN: {len(removals)} repository group privileges were removed within Bitbucket Server, re-run with --revoke to remove them from your cloud workspace too.')
+            for removal in removals:
+                del self.pushed.privileges[removal]
+            return
+        remove = lambda removal: CA.remove_group_from_repo(self.cloud, *removal)
+        for (repo_slug, group_name), success in zip(removals, executor.map(remove, removals)):
+            if success:
+                del self.pushed.privileges[(repo_slug, group_name)]
+                counts['revoked'] += 1
+            else:
+                counts['failed'] += 1
+                progress.fail('repos', 'write_failed', operation='remove_group_from_repo', group=group_name, repo=repo_slug)